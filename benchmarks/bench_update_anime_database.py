@@ -0,0 +1,161 @@
+"""
+Benchmark a full update_anime_database pass against a synthetic AniList feed.
+
+The AniList API is replaced by an in-memory fake, so the numbers only measure
+the local work (parsing and SQLite). Each mode runs on a fresh database:
+
+- legacy: every helper opens and closes its own sqlite3 connection, as the
+  code did before the shared connection layer
+- shared: the thread-local WAL connection from db_connection
+
+Usage: python benchmarks/bench_update_anime_database.py [anime_count] [franchise_size]
+"""
+import os
+import sys
+import time
+import sqlite3
+import logging
+import tempfile
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+for key, value in {
+    "SAVE_LOGS_TO_FILE": "false",
+    "LOG_FOLDER": tempfile.gettempdir(),
+    "INFO_LOG_MAX_BYTES_SIZE": "1000000",
+    "ERROR_LOG_MAX_BYTES_SIZE": "1000000",
+    "BOT_TOKEN": "benchmark",
+    "DATABASE_PATH": os.path.join(tempfile.gettempdir(), "anipush_bench.db"),
+    "REFRESH_MODE": "feed",
+}.items():
+    os.environ.setdefault(key, value)
+
+import custom_config  # noqa: E402
+import custom_logging  # noqa: E402
+import anilist_api_interactor  # noqa: E402
+import daemon_connectors  # noqa: E402
+import db_connection  # noqa: E402
+import db_interactor  # noqa: E402
+
+PAGE_SIZE = 50
+BASE_UPDATED_AT = 1_700_000_000
+OPENED_CONNECTIONS = 0
+
+
+def fake_media(anime_id: int, anime_count: int, franchise_size: int) -> dict:
+    first = anime_id - (anime_id - 1) % franchise_size
+    edges = []
+    if anime_id > first:
+        edges.append({"relationType": "PREQUEL", "node": {"id": anime_id - 1, "format": "TV"}})
+    if anime_id < min(first + franchise_size - 1, anime_count):
+        edges.append({"relationType": "SEQUEL", "node": {"id": anime_id + 1, "format": "TV"}})
+    edges.append({"relationType": "ADAPTATION", "node": {"id": 10_000_000 + anime_id, "format": "MANGA"}})
+    return {
+        "id": anime_id,
+        "type": "ANIME",
+        "format": "TV",
+        "status": "FINISHED",
+        "episodes": 12,
+        "updatedAt": BASE_UPDATED_AT + anime_id,
+        "title": {"romaji": f"Anime {anime_id}", "english": None},
+        "coverImage": {"extraLarge": f"https://example.org/{anime_id}.jpg"},
+        "nextAiringEpisode": None,
+        "startDate": {"year": 2000 + anime_id % 20, "month": 1 + anime_id % 12, "day": 1},
+        "relations": {"edges": edges},
+    }
+
+
+def fake_anilist(anime_count: int, franchise_size: int):
+    def send_request_to_anilist(query: str, variables: dict, title: str) -> dict | None:
+        if "mediaId" in variables:
+            media = [fake_media(i, anime_count, franchise_size) for i in variables["mediaId"]]
+            return {"data": {"Page": {"media": media}}}
+        page = variables["page"]
+        newest = anime_count - (page - 1) * PAGE_SIZE
+        ids = list(range(newest, max(newest - PAGE_SIZE, 0), -1))
+        return {"data": {"Page": {
+            "pageInfo": {"perPage": PAGE_SIZE, "hasNextPage": newest - PAGE_SIZE > 0},
+            "media": [fake_media(i, anime_count, franchise_size) for i in ids],
+        }}}
+    return send_request_to_anilist
+
+
+def fake_async_anilist(send_request_to_anilist):
+    async def send_request(self, query: str, variables: dict, title: str) -> dict | None:
+        return send_request_to_anilist(query, variables, title)
+    return send_request
+
+
+@contextmanager
+def legacy_connection(immediate: bool = False):
+    # immediate is ignored, every call commits on its own as before
+    global OPENED_CONNECTIONS
+    OPENED_CONNECTIONS += 1
+    conn = sqlite3.connect(custom_config.DATABASE_PATH)
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def counting_open_connection(open_connection):
+    def wrapper() -> sqlite3.Connection:
+        global OPENED_CONNECTIONS
+        OPENED_CONNECTIONS += 1
+        return open_connection()
+    return wrapper
+
+
+def reset_database():
+    db_connection.close_connection()
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(custom_config.DATABASE_PATH + suffix):
+            os.remove(custom_config.DATABASE_PATH + suffix)
+
+
+def run(mode: str, anime_count: int, franchise_size: int) -> tuple[float, int]:
+    global OPENED_CONNECTIONS
+    reset_database()
+    patched_modules = [db_interactor, daemon_connectors, anilist_api_interactor]
+    original_connections = [m.connection for m in patched_modules]
+    original_open = db_connection.open_connection
+    if mode == "legacy":
+        for m in patched_modules:
+            m.connection = legacy_connection
+    else:
+        db_connection.open_connection = counting_open_connection(original_open)
+    try:
+        db_interactor.init_db()
+        OPENED_CONNECTIONS = 0
+        start = time.perf_counter()
+        daemon_connectors.update_anime_database()
+        elapsed = time.perf_counter() - start
+    finally:
+        for m, c in zip(patched_modules, original_connections):
+            m.connection = c
+        db_connection.open_connection = original_open
+        reset_database()
+    return elapsed, OPENED_CONNECTIONS
+
+
+def main():
+    anime_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    franchise_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    if custom_logging.LOGGER is not None:
+        custom_logging.LOGGER.setLevel(logging.WARNING)
+    anilist_api_interactor.send_request_to_anilist = fake_anilist(anime_count, franchise_size)
+    anilist_api_interactor.AsyncAniListClient.send_request = fake_async_anilist(
+        anilist_api_interactor.send_request_to_anilist)
+    print(f"update_anime_database: {anime_count} anime, franchises of {franchise_size}")
+    results = {}
+    for mode in ["legacy", "shared"]:
+        elapsed, opened = run(mode, anime_count, franchise_size)
+        results[mode] = elapsed
+        print(f"{mode:>8}: {elapsed:8.3f}s  connections opened: {opened}")
+    if results["shared"] > 0:
+        print(f" speedup: {results['legacy'] / results['shared']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
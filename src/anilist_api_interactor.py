@@ -1,64 +1,98 @@
-import json, time, datetime, logging
+import json, time, datetime, logging, asyncio
+import httpx
 import requests
-from custom_dataclasses import AnimeData, AnimeRelation
+from requests.adapters import HTTPAdapter
+from dataclasses import replace
+from custom_dataclasses import AnimeData, AnimeRelation, StageStats, SyncState
 from custom_logging import set_logger
-from db_interactor import add_anime_bulk, add_relations_bulk
-from queries import GET_ANIME_DATA_FROM_ID, GET_NEW_UPDATES, GET_NEW_USER_ACTIVITIES, GET_WATCHED_ANIME
+from db_connection import connection
+from db_interactor import add_anime_bulk, add_relations_bulk, save_sync_state
+from rate_limiter import RateLimiter, backoff_delay
+from queries import GET_ANILIST_ID_FROM_USERNAME, GET_ANIME_DATA_FROM_ID, GET_NEW_UPDATES, GET_NEW_USER_ACTIVITIES, GET_WATCHED_ANIME, build_batch_user_activities_query
+from utils import chunk_list
 
 log = set_logger("API_INTERACTOR", logging.INFO)
 
 WRITTEN_DATA_FORMAT = ["MANGA", "NOVEL", "ONE_SHOT"]
 MAX_ANIME_PER_QUERY = 25
+USERS_PER_ACTIVITY_QUERY = 10
+PIPELINE_QUEUE_SIZE = 4
 MAX_TRIES = 4
 MAX_DATE=int(datetime.datetime(year=3099, month=1, day=1).timestamp())
 INTERESTING_ACTIVITIES = ["completed", "plans to watch", "dropped", "watched episode"]
 API_URL = "https://graphql.anilist.co"
+MAX_POOLED_CONNECTIONS = 10
+MAX_REQUEST_ATTEMPTS = 3
+# Share of the rate limit kept for priority clients (onboarding a new user)
+PRIORITY_REQUEST_SHARE = 0.25
+
+# Shared by the sync and async clients, anilist counts requests per IP
+RATE_LIMITER = RateLimiter(priority_share=PRIORITY_REQUEST_SHARE)
+
+# One pooled session for every synchronous request: the TCP+TLS connection to
+# anilist is kept alive between requests instead of being opened every time
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_POOLED_CONNECTIONS))
+
+def evaluate_anilist_response(response:requests.Response|httpx.Response, attempt:int)->tuple[dict|None, float|None]:
+    """Returns the response data, or how many seconds to wait before retrying (None: don't retry)"""
+    RATE_LIMITER.update(response.headers)
+    if response.status_code == 403:
+        log.warning("\t[!] The anilist api seems unavailiable, returned status code 403.")
+        RATE_LIMITER.open_circuit()
+        return None, None
+    if response.status_code == 429:
+        log.warning("\t[!] Rate limit has been exceeded, waiting")
+        pause = RATE_LIMITER.pause(response.headers)
+        log.info(f"\t[i] Retrying in {pause} seconds (retry-after time)")
+        return None, 0
+    if response.status_code >= 500:
+        delay = backoff_delay(attempt)
+        log.warning(f"\t[!] The anilist api returned status code {response.status_code}, retrying in {delay:.1f} seconds")
+        return None, delay
+    if response.status_code != 200:
+        response.raise_for_status()
+    j = response.json()
+    if "errors" in j:
+        log.error("\t[!] The anilist api returned error(s) in the response")
+        for e in j['errors']:
+            log.error("\t[!] "+json.dumps(e))
+        delay = backoff_delay(attempt)
+        log.info(f"\t[i] Retrying in {delay:.1f} seconds")
+        return None, delay
+    return j, 0
+
+def request_failed(e:Exception, attempt:int)->float:
+    delay = backoff_delay(attempt)
+    log.error(f"\t[!] Something went wrong when fetching anime list: {e}")
+    log.info(f"\t[i] Retrying in {delay:.1f} seconds")
+    return delay
+
+def log_request_result(data:dict|None, title:str):
+    if data is None:
+        log.info(f"[!] Could not get the correct data for request {title}")
+    else:
+        log.info(f"[+] Done sending request: {title}")
 
 def send_request_to_anilist(query:str, variables:dict, title:str)-> dict|None:
     data = None
     log.info(f"[.] Sending request to anilist: {title}")
-    for i in range(3):
-        try:
-            time.sleep(4)
-            response = requests.post(API_URL, json={"query": query, "variables": variables}, timeout=30)
-            if response.status_code == 403:
-                log.warning("\t[!] The anilist api seems unavailiable, returned status code 403.")
-                if i<2:
-                    log.info("\t[i] Retrying in 1 hour")
-                    time.sleep(3600)
-                continue
-            if response.status_code == 429:
-                log.warning("\t[!] Rate limit has been exceeded, waiting")
-                retry_after = response.headers.get("Retry-After")
-                if retry_after and isinstance(retry_after, int):
-                    time_after_retry = int(retry_after)+1
-                    log.info(f"\t[i] Retrying in {time_after_retry} seconds (retry-after time)")
-                    time.sleep(time_after_retry)
-                else:
-                    log.info("\t[i] Retrying in 61 seconds")
-                    time.sleep(61)
-                continue
-            if response.status_code != 200:
-                response.raise_for_status()
-            j = response.json()
-            if "errors" in j:
-                log.error("\t[!] The anilist api returned error(s) in the response")
-                for e in j['errors']:
-                    log.error("\t[!] "+json.dumps(e))
-                log.info("\t[i] Retrying in 15 seconds")
-                time.sleep(15)
-                continue
-            data = j
+    for i in range(MAX_REQUEST_ATTEMPTS):
+        wait = RATE_LIMITER.reserve()
+        if wait is None:
+            log.warning("\t[!] The anilist api is unavailable (circuit breaker open), skipping the request")
             break
+        time.sleep(wait)
+        try:
+            response = SESSION.post(API_URL, json={"query": query, "variables": variables}, timeout=30)
+            data, retry_delay = evaluate_anilist_response(response, i)
         except Exception as e:
-            log.error(f"\t[!] Something went wrong when fetching anime list: {e}")
-            if i<2:
-                log.info("\t[i] Retrying in 15 seconds")
-                time.sleep(15)
-    if data is None:
-        log.info(f"[!] Could not get the correct data for request {title}")
-    else:
-        log.info(f"[+] Done sending request: {title}")
+            retry_delay = request_failed(e, i)
+        if data is not None or retry_delay is None:
+            break
+        if i < MAX_REQUEST_ATTEMPTS-1:
+            time.sleep(retry_delay)
+    log_request_result(data, title)
     return data
 
 def parse_media(m:dict)->tuple[AnimeData, list[AnimeRelation]] | None:
@@ -86,8 +120,10 @@ def parse_media(m:dict)->tuple[AnimeData, list[AnimeRelation]] | None:
     if m['title']['english'] is not None and len(m['title']['english']) > 0:
         title = m['title']['english']
     latest_episode = m['episodes']
+    next_episode_airing_at = 0
     if m['nextAiringEpisode'] is not None and 'episode' in m['nextAiringEpisode'] and m['nextAiringEpisode']['episode'] is not None:
         latest_episode = m['nextAiringEpisode']['episode'] - 1
+        next_episode_airing_at = m['nextAiringEpisode'].get('airingAt') or 0
     start_date = MAX_DATE
     if m['startDate']['year'] is not None and m['startDate']['month'] is not None and m['startDate']['day'] is not None:
         start_date = int(datetime.datetime(year=m['startDate']['year'], month=m['startDate']['month'], day=m['startDate']['day']).timestamp())
@@ -100,7 +136,8 @@ def parse_media(m:dict)->tuple[AnimeData, list[AnimeRelation]] | None:
         episodes=m['episodes'],
         latest_aired_episode=latest_episode,
         start_date=start_date,
-        updated_date=m['updatedAt']
+        updated_date=m['updatedAt'],
+        next_episode_airing_at=next_episode_airing_at
     )
     log.debug(f"\t\t[+] Added anime {m['id']} to list")
     if m['relations']['edges'] is None:
@@ -117,11 +154,7 @@ def parse_media(m:dict)->tuple[AnimeData, list[AnimeRelation]] | None:
         ))
     return (anime, relations)
 
-def get_watched_anime(username:str)->list[int]|None:
-    variables = {
-        "userName": username
-    }
-    data = send_request_to_anilist(GET_WATCHED_ANIME, variables, "get_watched_anime")
+def parse_watched_anime(data:dict|None)->list[int]|None:
     if data is None or 'data' not in data or \
         'MediaListCollection' not in data['data'] or \
         'lists' not in data['data']['MediaListCollection']:
@@ -141,148 +174,439 @@ def get_watched_anime(username:str)->list[int]|None:
             anime_list.append(entry['media']['id'])
     return anime_list
 
+def get_watched_anime(username:str)->list[int]|None:
+    variables = {
+        "userName": username
+    }
+    data = send_request_to_anilist(GET_WATCHED_ANIME, variables, "get_watched_anime")
+    return parse_watched_anime(data)
+
+def parse_anime_data_page(data:dict|None, anime_portion:list[int])->list[tuple[AnimeData, list[AnimeRelation]]]|None:
+    if data is None or 'data' not in data or \
+        'Page' not in data['data'] or \
+        'media' not in data['data']['Page']:
+        log.error("\t\t[!] The json structure returned by anilist is wrong!")
+        return None
+    media_list = data['data']['Page']['media'] or []
+    if len(media_list) != len(anime_portion):
+        # Usually anime deleted from anilist: keep what was returned, callers
+        # can find the missing ids by comparing with the requested ones
+        returned_ids = [m.get('id') for m in media_list]
+        log.warning(f"\t\t[!] The returned anilist data is incomplete, missing {[i for i in anime_portion if i not in returned_ids]}")
+
+    anime_data_list : list[tuple[AnimeData, list[AnimeRelation]]] = []
+    for m in media_list:
+        res = parse_media(m)
+        if res is None:
+            if "id" in m:
+                log.error(f"[!] Something went wrong while getting anime data {m['id']}!")
+            else:
+                log.error("[!] Something went wrong while getting anime data (Unkwnown id)!")
+            continue
+        anime_data_list.append(res)
+    return anime_data_list
+
+def anime_data_variables(anime_portion:list[int])->dict:
+    return {
+        "page":1,
+        "perPage":MAX_ANIME_PER_QUERY,
+        "mediaId":anime_portion
+    }
+
 def get_anime_data_from_id(anime_id_list:list[int])->list[tuple[AnimeData, list[AnimeRelation]]]|None:
     log.info("\t\t[+] Getting anime data from id")
     anime_data_list : list[tuple[AnimeData, list[AnimeRelation]]] = []
-    for i in range((len(anime_id_list)//MAX_ANIME_PER_QUERY)+1):
-        anime_portion = anime_id_list[
-            i*MAX_ANIME_PER_QUERY: min((i+1)*MAX_ANIME_PER_QUERY, len(anime_id_list))
-        ]
-        variables = {
-            "page":1,
-            "perPage":MAX_ANIME_PER_QUERY,
-            "mediaId":anime_portion
-        }
-        data = send_request_to_anilist(GET_ANIME_DATA_FROM_ID, variables, "get_anime_data_from_id")
-        if data is None or 'data' not in data or \
-            'Page' not in data['data'] or \
-            'media' not in data['data']['Page']:
-            log.error("\t\t[!] The json structure returned by anilist is wrong!")
-            return None
-        media_list = data['data']['Page']['media']
-        if not media_list or len(media_list) != len(anime_portion):
-            log.error("\t\t[!] The returned anilist data is wrong, length does not match!")
+    for anime_portion in chunk_list(anime_id_list, MAX_ANIME_PER_QUERY):
+        data = send_request_to_anilist(GET_ANIME_DATA_FROM_ID, anime_data_variables(anime_portion), "get_anime_data_from_id")
+        res = parse_anime_data_page(data, anime_portion)
+        if res is None:
             return None
+        anime_data_list += res
+    return anime_data_list
 
-        for m in media_list:
-            res = parse_media(m)
-            if res is None:
-                if "id" in m:
-                    log.error(f"[!] Something went wrong while getting anime data {m['id']}!")
-                else:
-                    log.error("[!] Something went wrong while getting anime data (Unkwnown id)!")
-                continue
-            anime_data_list.append(res)
+def parse_user_activity_page(data:dict|None, new_anime:list[int], deleted_media:list[int], max_date:int)->tuple[bool, int]|None:
+    """Adds the page activities to new_anime and deleted_media, returns (hasNextPage, max_date)"""
+    if data is None or 'data' not in data or \
+        'Page' not in data['data'] or \
+        'pageInfo' not in data['data']['Page'] or \
+        'hasNextPage' not in data['data']['Page']['pageInfo'] or \
+        'activities' not in data['data']['Page']:
+        log.error("The json structure returned by anilist is wrong!")
+        return None
+    activities = data['data']['Page']['activities']
+    for a in activities:
+        if 'status' not in a or \
+            'createdAt' not in a or \
+            'media' not in a or \
+            'id' not in a['media']:
+            log.debug(f"The json structure of activity {a} returned by anilist is wrong!")
+            continue
+        if a['status'] not in INTERESTING_ACTIVITIES:
+            log.warning(f"[!] Found unhandled activity status {a['status']} for activity {a['id']}, skipping")
+            continue
+        if a["createdAt"] > max_date:
+            max_date = a["createdAt"]
+        if a['media']['id'] in deleted_media or a['media']['id'] in new_anime:
+            continue
+        if a['status'] == "completed" or a['status'] == "plans to watch" or a['status'] == 'watched episode':
+            new_anime.append(a['media']['id'])
+        elif a['status'] == "dropped":
+            deleted_media.append(a['media']['id'])
+    return data['data']['Page']['pageInfo']['hasNextPage'], max_date
 
-    return anime_data_list
+def batch_user_activity_variables(users:list[tuple[int, int]])->dict:
+    variables = {}
+    for index, (user_id, last_activity) in enumerate(users):
+        variables[f"id{index}"] = user_id
+        variables[f"createdAtGreater{index}"] = last_activity
+    return variables
 
-def get_new_user_activity(user_id:int, last_activity:int)->tuple[list[int], list[int], int]:
-    log.info(f"\t[.] Getting new user activities user_id:{user_id}, last_activity:{last_activity}")
-    current_page = 1
-    max_date = last_activity
-    new_anime :list[int] = []
-    deleted_media :list[int] = []
-    while True:
-        variables = {
-            "id": user_id,
-            "createdAtGreater": last_activity,
-            "page":current_page
-        }
-        data = send_request_to_anilist(GET_NEW_USER_ACTIVITIES, variables, "get_new_user_activity")
-        if data is None or 'data' not in data or \
-            'Page' not in data['data'] or \
-            'pageInfo' not in data['data']['Page'] or \
-            'hasNextPage' not in data['data']['Page']['pageInfo'] or \
-            'activities' not in data['data']['Page']:
-            log.error("The json structure returned by anilist is wrong!")
-            return [], [], last_activity
-        activities = data['data']['Page']['activities']
-        for a in activities:
-            if 'status' not in a or \
-                'createdAt' not in a or \
-                'media' not in a or \
-                'id' not in a['media']:
-                log.debug(f"The json structure of activity {a} returned by anilist is wrong!")
-                continue
-            if a['status'] not in INTERESTING_ACTIVITIES:
-                log.warning(f"[!] Found unhandled activity status {a['status']} for activity {a['id']}, skipping")
-                continue
-            if a["createdAt"] > max_date:
-                max_date = a["createdAt"]
-            if a['media']['id'] in deleted_media or a['media']['id'] in new_anime:
-                continue
-            if a['status'] == "completed" or a['status'] == "plans to watch" or a['status'] == 'watched episode':
-                new_anime.append(a['media']['id'])
-            elif a['status'] == "dropped":
-                deleted_media.append(a['media']['id'])
+def batch_user_activity_page(data:dict, index:int)->dict|None:
+    """The aliased page of a single user, shaped like a GET_NEW_USER_ACTIVITIES response"""
+    alias = f"user{index}"
+    if 'data' not in data or data['data'] is None or alias not in data['data']:
+        return None
+    return {'data': {'Page': data['data'][alias]}}
 
-        if not data['data']['Page']['pageInfo']['hasNextPage']:
-            break
-        current_page += 1
-    return new_anime, deleted_media, max_date
-
-def get_new_updates(last_update_time:int, add_each_page:bool)->tuple[list[AnimeData], list[AnimeRelation]]:
-    anime_updates_list : dict[int, AnimeData] = {}
-    relations_list :list[AnimeRelation]= []
-    current_page = 1
-    current_tries = 1
-    while True:
-        if add_each_page:
-            anime_updates_list : dict[int, AnimeData] = {}
-            relations_list :list[AnimeRelation]= []
-        variables = {
-            "perPage": 50,
-            "page":current_page
-        }
-        log.debug(f"\t\t[.] Fetching updates for page {current_page}")
-        data = send_request_to_anilist(GET_NEW_UPDATES, variables, "get_new_anime_updates")
-        if data is None or 'data' not in data or \
-            'Page' not in data['data'] or \
-            'pageInfo' not in data['data']['Page'] or \
-            'hasNextPage' not in data['data']['Page']['pageInfo'] or \
-            'media' not in data['data']['Page']:
-            log.error("\t\t[!] The json structure returned by anilist is wrong!")
-            return [], []
-        media_list = data['data']['Page']['media']
-        log.debug(f"\t\t[+] Found {len(media_list)} updates to add on page {current_page}")
-        if (len(media_list) == 0 or (len(media_list) != 50 and data['data']['Page']['pageInfo']['hasNextPage']))and current_tries <= MAX_TRIES:
-            log.info(f"\t\t[i] Trying to fetch updates for this page a couple more times just to be sure! try {current_tries}/{MAX_TRIES}")
-            current_tries += 1
+def parse_batch_user_activity(data:dict, users:list[tuple[int, int]])->list[tuple[list[int], list[int], int, bool]]:
+    """Returns (new_anime, deleted_media, max_date, has_next_page) for each user"""
+    results = []
+    for index, (user_id, last_activity) in enumerate(users):
+        new_anime :list[int] = []
+        deleted_media :list[int] = []
+        res = parse_user_activity_page(batch_user_activity_page(data, index), new_anime, deleted_media, last_activity)
+        if res is None:
+            log.error(f"\t[!] Could not get the activities of user {user_id}")
+            results.append(([], [], last_activity, False))
             continue
-        else:
-            current_tries = 1
+        has_next_page, max_date = res
+        results.append((new_anime, deleted_media, max_date, has_next_page))
+    return results
 
-        for m in media_list:
-            if 'updatedAt' not in m:
-                log.debug(f"The json structure of media {json.dumps(m)} returned by anilist is wrong!")
-                continue
-            if m['updatedAt'] < last_update_time:
-                log.debug(f"\t\t[!] The time {m['updatedAt']} is less than the last updated time {last_update_time}!")
-                data['data']['Page']['pageInfo']['hasNextPage'] = False
-                break
-            res = parse_media(m)
-            if res is None:
-                continue
-            anime_updates_list[res[0].id] = res[0]
-            relations_list += res[1]
-        if add_each_page:
-            add_relations_bulk(relations_list)
-            add_anime_bulk(list(anime_updates_list.values()))
-        if not data['data']['Page']['pageInfo']['hasNextPage']:
-            break
-        current_page += 1
-    return list(anime_updates_list.values()), relations_list
+def check_updates_page(data:dict|None)->list[dict]|None:
+    if data is None or 'data' not in data or \
+        'Page' not in data['data'] or \
+        'pageInfo' not in data['data']['Page'] or \
+        'hasNextPage' not in data['data']['Page']['pageInfo'] or \
+        'media' not in data['data']['Page']:
+        log.error("\t\t[!] The json structure returned by anilist is wrong!")
+        return None
+    return data['data']['Page']['media']
 
-def get_anilist_id_from_username(username: str) -> int | None:
-    query = '''
-    query ($name: String) {
-      User(name: $name) {
-        id
-      }
-    }
-    '''
-    variables = {"name": username}
-    data = send_request_to_anilist(query, variables, f"get_anilist_id_from_username {username}")
+def should_retry_updates_page(data:dict, current_page:int, current_tries:int)->bool:
+    media_list = data['data']['Page']['media']
+    log.debug(f"\t\t[+] Found {len(media_list)} updates to add on page {current_page}")
+    if (len(media_list) == 0 or (len(media_list) != 50 and data['data']['Page']['pageInfo']['hasNextPage']))and current_tries <= MAX_TRIES:
+        log.info(f"\t\t[i] Trying to fetch updates for this page a couple more times just to be sure! try {current_tries}/{MAX_TRIES}")
+        return True
+    return False
+
+def parse_updates_page(data:dict, last_update_time:int, anime_updates_list:dict[int, AnimeData], relations_list:list[AnimeRelation])->bool:
+    """Adds the page media newer than last_update_time to the lists, returns whether the crawl must go on"""
+    for m in data['data']['Page']['media']:
+        if 'updatedAt' not in m:
+            log.debug(f"The json structure of media {json.dumps(m)} returned by anilist is wrong!")
+            continue
+        if m['updatedAt'] < last_update_time:
+            log.debug(f"\t\t[!] The time {m['updatedAt']} is less than the last updated time {last_update_time}!")
+            return False
+        res = parse_media(m)
+        if res is None:
+            continue
+        anime_updates_list[res[0].id] = res[0]
+        relations_list += res[1]
+    return data['data']['Page']['pageInfo']['hasNextPage']
+
+def start_crawl(state:SyncState):
+    if state.crawl_watermark is None:
+        state.crawl_watermark = state.watermark
+        state.current_page = 1
+        state.page_tries = 1
+        state.high_water_mark = state.watermark
+        log.info(f"\t\t[.] Starting a new update crawl down to {state.crawl_watermark}")
+        return
+    # Anime updated in the meantime move to the top of the feed and shift the
+    # rest up, the page before the checkpoint is read again so none is skipped
+    state.current_page = max(1, state.current_page - 1)
+    log.info(f"\t\t[.] Resuming the update crawl down to {state.crawl_watermark} from page {state.current_page}")
+
+def advance_crawl(state:SyncState, anime_list:list[AnimeData], has_next_page:bool):
+    state.high_water_mark = max([state.high_water_mark] + [anime.updated_date for anime in anime_list])
+    state.current_page += 1
+    state.page_tries = 1
+    if not has_next_page:
+        # Complete pass: only now the next crawl can stop earlier
+        state.watermark = max(state.watermark, state.high_water_mark)
+        state.crawl_watermark = None
+        state.current_page = 1
+        log.info(f"\t\t[+] Update crawl complete, watermark is now {state.watermark}")
+
+def store_updates_page(anime_list:list[AnimeData], relations_list:list[AnimeRelation], state:SyncState):
+    """The page and the checkpoint that follows it are committed together, or neither is"""
+    # The helpers read before they write, the write lock is taken before any of them runs
+    with connection(immediate=True):
+        # The helpers log and swallow their errors, raising rolls the checkpoint back with them
+        if add_relations_bulk(relations_list) is None:
+            raise Exception("Could not store the relations of the update page")
+        if not add_anime_bulk(anime_list):
+            raise Exception("Could not store the anime of the update page")
+        save_sync_state(state)
+
+def parse_anilist_id(data:dict|None)->int|None:
     if data and 'data' in data and 'User' in data['data'] and data['data']['User'] and 'id' in data['data']['User']:
         return data['data']['User']['id']
     return None
+
+def get_anilist_id_from_username(username: str) -> int | None:
+    data = send_request_to_anilist(GET_ANILIST_ID_FROM_USERNAME, {"name": username}, f"get_anilist_id_from_username {username}")
+    return parse_anilist_id(data)
+
+class AsyncAniListClient:
+    """
+    Asyncio counterpart of the request functions above.
+
+    All requests go through one httpx.AsyncClient, so connections to anilist
+    are pooled and kept alive for the lifetime of the client. Use it as an
+    async context manager inside the event loop that runs the requests.
+    The requests of a priority client take the share of the rate limit
+    kept for them instead of waiting behind the daemon's.
+    """
+
+    def __init__(self, priority:bool=False):
+        self.priority = priority
+        self.client = httpx.AsyncClient(
+            timeout=30,
+            limits=httpx.Limits(max_connections=MAX_POOLED_CONNECTIONS, max_keepalive_connections=MAX_POOLED_CONNECTIONS)
+        )
+
+    async def __aenter__(self)->"AsyncAniListClient":
+        return self
+
+    async def __aexit__(self, *_):
+        await self.client.aclose()
+
+    async def send_request(self, query:str, variables:dict, title:str)->dict|None:
+        data = None
+        log.info(f"[.] Sending request to anilist: {title}")
+        for i in range(MAX_REQUEST_ATTEMPTS):
+            wait = RATE_LIMITER.reserve(self.priority)
+            if wait is None:
+                log.warning("\t[!] The anilist api is unavailable (circuit breaker open), skipping the request")
+                break
+            await asyncio.sleep(wait)
+            try:
+                response = await self.client.post(API_URL, json={"query": query, "variables": variables})
+                data, retry_delay = evaluate_anilist_response(response, i)
+            except Exception as e:
+                retry_delay = request_failed(e, i)
+            if data is not None or retry_delay is None:
+                break
+            if i < MAX_REQUEST_ATTEMPTS-1:
+                await asyncio.sleep(retry_delay)
+        log_request_result(data, title)
+        return data
+
+    async def get_anilist_id_from_username(self, username:str)->int|None:
+        data = await self.send_request(GET_ANILIST_ID_FROM_USERNAME, {"name": username}, f"get_anilist_id_from_username {username}")
+        return parse_anilist_id(data)
+
+    async def get_watched_anime(self, username:str)->list[int]|None:
+        data = await self.send_request(GET_WATCHED_ANIME, {"userName": username}, "get_watched_anime")
+        return parse_watched_anime(data)
+
+    async def get_anime_data_from_id(self, anime_id_list:list[int])->list[tuple[AnimeData, list[AnimeRelation]]]|None:
+        log.info("\t\t[+] Getting anime data from id")
+        portions = chunk_list(anime_id_list, MAX_ANIME_PER_QUERY)
+        pages = await asyncio.gather(*[
+            self.send_request(GET_ANIME_DATA_FROM_ID, anime_data_variables(p), "get_anime_data_from_id")
+            for p in portions
+        ])
+        anime_data_list : list[tuple[AnimeData, list[AnimeRelation]]] = []
+        for data, anime_portion in zip(pages, portions):
+            res = parse_anime_data_page(data, anime_portion)
+            if res is None:
+                return None
+            anime_data_list += res
+        return anime_data_list
+
+    async def get_user_activity_pages(self, user_id:int, last_activity:int, current_page:int, new_anime:list[int], deleted_media:list[int], max_date:int)->tuple[list[int], list[int], int]:
+        while True:
+            variables = {
+                "id": user_id,
+                "createdAtGreater": last_activity,
+                "page":current_page
+            }
+            data = await self.send_request(GET_NEW_USER_ACTIVITIES, variables, "get_new_user_activity")
+            res = parse_user_activity_page(data, new_anime, deleted_media, max_date)
+            if res is None:
+                return [], [], last_activity
+            has_next_page, max_date = res
+            if not has_next_page:
+                break
+            current_page += 1
+        return new_anime, deleted_media, max_date
+
+    async def get_new_user_activity(self, user_id:int, last_activity:int)->tuple[list[int], list[int], int]:
+        log.info(f"\t[.] Getting new user activities user_id:{user_id}, last_activity:{last_activity}")
+        return await self.get_user_activity_pages(user_id, last_activity, 1, [], [], last_activity)
+
+    async def get_new_user_activity_portion(self, portion:list[tuple[int, int]], timeout:float|None=None)->dict[int, tuple[list[int], list[int], int]]:
+        """
+        get_new_user_activity for up to USERS_PER_ACTIVITY_QUERY users: the first
+        page of every user is fetched with one aliased query, only the users with
+        more pages are then paginated one by one. With a timeout, the users whose
+        activities take longer are left out of the result
+        """
+        results : dict[int, tuple[list[int], list[int], int]] = {}
+        log.info(f"\t[.] Getting new user activities of {len(portion)} users")
+        try:
+            data = await asyncio.wait_for(self.send_request(build_batch_user_activities_query(len(portion)), batch_user_activity_variables(portion), "get_new_user_activity_batch"), timeout)
+        except asyncio.TimeoutError:
+            log.warning(f"\t[!] Timed out getting the activities of users {[u for u, _ in portion]}, skipping them")
+            return results
+        if data is None:
+            log.warning("\t[!] The batched activity request failed, falling back to one request per user")
+            pages = [(user_id, self.get_new_user_activity(user_id, last_activity)) for user_id, last_activity in portion]
+        else:
+            pages = []
+            for (user_id, last_activity), (new_anime, deleted_media, max_date, has_next_page) in zip(portion, parse_batch_user_activity(data, portion)):
+                if has_next_page:
+                    log.info(f"\t[.] User {user_id} has more new activities, fetching the next pages")
+                    pages.append((user_id, self.get_user_activity_pages(user_id, last_activity, 2, new_anime, deleted_media, max_date)))
+                else:
+                    results[user_id] = (new_anime, deleted_media, max_date)
+        for user_id, coroutine in pages:
+            try:
+                results[user_id] = await asyncio.wait_for(coroutine, timeout)
+            except asyncio.TimeoutError:
+                log.warning(f"\t[!] Timed out getting the activities of user {user_id}, skipping it")
+        return results
+
+    async def get_new_updates(self, state:SyncState, add_each_page:bool)->tuple[list[AnimeData], list[AnimeRelation]]|None:
+        """
+        Crawl the update feed down to the watermark of state, run as an
+        UpdatePipeline. With add_each_page every page is stored with its
+        checkpoint as it comes, so an interrupted crawl is resumed by the next
+        call instead of being cut short, and nothing is returned.
+        None if the crawl failed
+        """
+        pipeline = UpdatePipeline(self, state, add_each_page)
+        await pipeline.run()
+        if pipeline.failed:
+            return None
+        return list(pipeline.anime_updates_list.values()), pipeline.relations_list
+
+def feed_continues(data:dict, last_update_time:int)->bool:
+    """Cheap version of the parse_updates_page stop condition, for the fetcher"""
+    if not data['data']['Page']['pageInfo']['hasNextPage']:
+        return False
+    return all(m.get('updatedAt', last_update_time) >= last_update_time for m in data['data']['Page']['media'])
+
+class UpdatePipeline:
+    """
+    The update crawl as three concurrent stages joined by bounded queues:
+    the fetcher downloads raw pages, the parser turns them into anime and
+    relations and advances the checkpoint, the writer stores them (with the
+    checkpoint) on a worker thread. A full queue blocks the stage before it,
+    so a slow database slows the downloads instead of piling up pages.
+    """
+
+    def __init__(self, client:AsyncAniListClient, state:SyncState, add_each_page:bool):
+        self.client = client
+        self.state = state
+        self.add_each_page = add_each_page
+        self.raw_pages : asyncio.Queue[tuple[dict|None, int]|None] = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        self.parsed_pages : asyncio.Queue[tuple[list[AnimeData], list[AnimeRelation], SyncState, bool]|None] = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        self.stats = {name: StageStats(name) for name in ["fetch", "parse", "write"]}
+        self.anime_updates_list : dict[int, AnimeData] = {}
+        self.relations_list : list[AnimeRelation] = []
+        self.fetch_failed = False
+        self.write_failed = False
+
+    @property
+    def failed(self)->bool:
+        return self.fetch_failed or self.write_failed
+
+    async def fetch_stage(self):
+        current_page = self.state.current_page
+        current_tries = self.state.page_tries
+        last_update_time = self.state.crawl_watermark or 0
+        try:
+            while not self.write_failed:
+                started = time.perf_counter()
+                variables = {
+                    "perPage": 50,
+                    "page":current_page
+                }
+                log.debug(f"\t\t[.] Fetching updates for page {current_page}")
+                data = await self.client.send_request(GET_NEW_UPDATES, variables, "get_new_anime_updates")
+                self.stats["fetch"].busy_seconds += time.perf_counter() - started
+                if check_updates_page(data) is None or data is None:
+                    # The pages already fetched are still parsed and written
+                    self.fetch_failed = True
+                    break
+                self.stats["fetch"].items += 1
+                if should_retry_updates_page(data, current_page, current_tries):
+                    current_tries += 1
+                    # Only the retry count goes down the pipeline, to be checkpointed in order
+                    await self.raw_pages.put((None, current_tries))
+                    continue
+                await self.raw_pages.put((data, current_tries))
+                if not feed_continues(data, last_update_time):
+                    break
+                current_page += 1
+                current_tries = 1
+        finally:
+            await self.raw_pages.put(None)
+
+    async def parse_stage(self):
+        while (item := await self.raw_pages.get()) is not None:
+            data, current_tries = item
+            started = time.perf_counter()
+            if data is None:
+                self.state.page_tries = current_tries
+                parsed = ([], [], replace(self.state), False)
+            else:
+                anime_updates_list : dict[int, AnimeData] = {}
+                relations_list : list[AnimeRelation] = []
+                has_next_page = parse_updates_page(data, self.state.crawl_watermark or 0, anime_updates_list, relations_list)
+                advance_crawl(self.state, list(anime_updates_list.values()), has_next_page)
+                parsed = (list(anime_updates_list.values()), relations_list, replace(self.state), True)
+                self.stats["parse"].items += 1
+            self.stats["parse"].busy_seconds += time.perf_counter() - started
+            await self.parsed_pages.put(parsed)
+        await self.parsed_pages.put(None)
+
+    async def write_stage(self):
+        while (item := await self.parsed_pages.get()) is not None:
+            anime_list, relations_list, checkpoint, is_page = item
+            started = time.perf_counter()
+            if self.write_failed:
+                # A page was not stored: the checkpoints after it must not be saved either
+                continue
+            if not self.add_each_page:
+                for anime in anime_list:
+                    self.anime_updates_list[anime.id] = anime
+                self.relations_list += relations_list
+            elif is_page:
+                try:
+                    await asyncio.to_thread(store_updates_page, anime_list, relations_list, checkpoint)
+                except Exception as e:
+                    log.error(f"\t\t[!] Stopping the update crawl, an update page could not be stored: {e}")
+                    self.write_failed = True
+                    continue
+            else:
+                await asyncio.to_thread(save_sync_state, checkpoint)
+            if is_page:
+                self.stats["write"].items += 1
+            self.stats["write"].busy_seconds += time.perf_counter() - started
+
+    async def run(self):
+        start_crawl(self.state)
+        started = time.perf_counter()
+        await asyncio.gather(self.fetch_stage(), self.parse_stage(), self.write_stage())
+        elapsed = time.perf_counter() - started
+        log.info(f"\t\t[i] Update pipeline done in {elapsed:.2f}s")
+        for stage in self.stats.values():
+            rate = stage.items / stage.busy_seconds if stage.busy_seconds > 0 else 0
+            log.info(f"\t\t[i] {stage.name} stage: {stage.items} pages, {stage.busy_seconds:.2f}s busy, {rate:.1f} pages/s")
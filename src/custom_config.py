@@ -9,6 +9,12 @@ def check_env(key: str) -> str:
         sys.exit()
     return v
 
+def get_env(key: str, default: str) -> str:
+    v = os.getenv(key)
+    if v is None or len(v) == 0:
+        return default
+    return v
+
 def get_int(value:str)->int:
     if not value.isdigit():
         print(f"ERROR: {value} can't be converted as int")
@@ -26,3 +32,13 @@ INFO_LOG_MAX_BYTES_SIZE = get_int(check_env("INFO_LOG_MAX_BYTES_SIZE"))
 ERROR_LOG_MAX_BYTES_SIZE = get_int(check_env("ERROR_LOG_MAX_BYTES_SIZE"))
 BOT_TOKEN= check_env("BOT_TOKEN")
 DATABASE_PATH=check_env("DATABASE_PATH")
+DATABASE_PROFILE=get_env("DATABASE_PROFILE", "default")
+# "targeted": refresh only the watched airing anime every cycle and crawl the
+# global update feed every GLOBAL_FEED_INTERVAL_SECONDS. "feed": crawl the feed every cycle
+REFRESH_MODE=get_env("REFRESH_MODE", "targeted")
+GLOBAL_FEED_INTERVAL_SECONDS=get_int(get_env("GLOBAL_FEED_INTERVAL_SECONDS", "21600"))
+# Users in digest mode get their notifications merged, at most once per window
+DIGEST_WINDOW_SECONDS=get_int(get_env("DIGEST_WINDOW_SECONDS", "3600"))
+# Activity polling: requests in flight at once, and seconds after which a user is skipped until the next pass
+ACTIVITY_POLL_CONCURRENCY=get_int(get_env("ACTIVITY_POLL_CONCURRENCY", "4"))
+ACTIVITY_POLL_TIMEOUT_SECONDS=get_int(get_env("ACTIVITY_POLL_TIMEOUT_SECONDS", "120"))
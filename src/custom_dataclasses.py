@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 
 @dataclass
@@ -12,6 +12,8 @@ class AnimeData:
     latest_aired_episode: int
     start_date: int
     updated_date: int
+    # Unix time of the next episode, 0 when nothing is scheduled
+    next_episode_airing_at: int = 0
 
 @dataclass
 class AnimeRelation:
@@ -19,3 +21,86 @@ class AnimeRelation:
     related_anilist_id: int
     relation_type: str
     date_update_found: int
+
+@dataclass
+class RelationsBulkResult:
+    inserted: int = 0
+    updated: int = 0
+    skipped: int = 0
+    invalidated_ids: list[int] = field(default_factory=list)
+
+@dataclass
+class SyncState:
+    name: str
+    # Updates older than this were all seen by a complete crawl
+    watermark: int
+    # Watermark the crawl in progress stops at, None when no crawl is in progress
+    crawl_watermark: int | None = None
+    current_page: int = 1
+    page_tries: int = 1
+    high_water_mark: int = 0
+
+@dataclass
+class OnboardingState:
+    telegram_id: int
+    anilist_username: str
+    # resolve_id -> fetch_list -> fetch_anime, see prepare_onboarding
+    step: str = "resolve_id"
+    anilist_id: int = -1
+    anime_ids: list[int] = field(default_factory=list)
+
+@dataclass
+class StageStats:
+    name: str
+    items: int = 0
+    busy_seconds: float = 0.0
+
+@dataclass
+class NotificationEvent:
+    # One per anime change, every recipient of the event gets the same message
+    event_key: str
+    anime_id: int
+    notification_type: str
+    # Rendered once when the event is queued
+    caption: str = ""
+    digest_line: str = ""
+    photo: str = ""
+    id: int = 0
+
+@dataclass
+class EventStats:
+    event_key: str
+    recipients: int
+    delivered: int
+    failed: int
+    wall_seconds: float
+
+@dataclass
+class TelegramNotification:
+    telegram_id: int
+    event: NotificationEvent
+
+@dataclass
+class DeliveryResult:
+    notification: TelegramNotification
+    delivered: bool
+    # Worth sending again later (network errors, 5xx, 429 after every retry)
+    retryable: bool = False
+    # Permanent failure of the chat (bot blocked, chat deleted): nothing more should be sent to it
+    chat_unreachable: bool = False
+    status_code: int | None = None
+    error: str | None = None
+    attempts: int = 0
+    # Telegram file_id of the cover uploaded by this send, None if it was already cached
+    file_id: str | None = None
+
+@dataclass
+class OutboxEntry:
+    # Unique per message, queueing the same key twice sends it once
+    idempotency_key: str
+    telegram_id: int
+    anime_id: int
+    notification_type: str
+    id: int = 0
+    attempts: int = 0
+    event_id: int | None = None
@@ -1,229 +1,503 @@
-import sqlite3
+import time
+import asyncio
+import threading
+from typing import Awaitable, Callable
 
+import custom_config
 from custom_logging import set_logger
-from anilist_api_interactor import get_anilist_id_from_username, get_anime_data_from_id, get_new_updates, get_new_user_activity, get_watched_anime
-from custom_dataclasses import AnimeData, AnimeRelation
-from db_interactor import add_anime_bulk, add_relations_bulk, add_user_anime_bulk, check_anime_in_db, delete_user_anime_bulk, find_next_unrelated_anime, get_anime_data, get_anime_relations, get_last_updated_at, get_last_user_activity, get_user_id_list, get_users_missing_ani_id, update_anime_related_to, update_last_user_activity, update_user_anilist_id, send_telegram_notification
+from anilist_api_interactor import MAX_ANIME_PER_QUERY, USERS_PER_ACTIVITY_QUERY, AsyncAniListClient, get_anilist_id_from_username, get_anime_data_from_id, get_watched_anime
+from custom_dataclasses import AnimeData, AnimeRelation, NotificationEvent, OnboardingState, OutboxEntry, SyncState, TelegramNotification
+from db_interactor import SQL_CHUNK_SIZE, add_anime_bulk, add_relations_bulk, deactivate_telegram_users, enqueue_notifications, finish_onboarding, get_cover_file_ids, get_due_airing_anime, get_last_user_activities, get_missing_anime_ids, get_onboarding_state, get_pending_notifications, get_pending_relation_resolutions, get_sync_state, get_user_id_list, get_users_missing_ani_id, get_watched_refresh_ids, postpone_airing_checks, update_anime_related_to_bulk, postpone_relation_resolutions, queue_anime_fetches, record_notification_results, save_cover_file_ids, save_onboarding_state, store_user_activities
+from db_connection import connection
+from utils import chunk_list
+from fetch_queue import FetchQueue
+from franchise_resolver import FranchiseResolver
+from telegram_dispatcher import dispatch_notifications
 
-import custom_config
 log = set_logger("DAEMON_CONNECTORS")
 
 
-ANIME_TO_SEARCH: list[int] = []
+RELATION_QUEUE_BATCH_SIZE = 100
+RELATION_RETRY_BASE_SECONDS = 10 * 60
+RELATION_RETRY_MAX_SECONDS = 7 * 24 * 60 * 60
+AIRING_RECHECK_SECONDS = 10 * 60
+UPDATE_FEED_SYNC_NAME = "update_feed"
 
+OUTBOX_BATCH_SIZE = 200
+OUTBOX_RETRY_BASE_SECONDS = 60
+OUTBOX_RETRY_MAX_SECONDS = 6 * 60 * 60
+OUTBOX_MAX_ATTEMPTS = 10
 
-def check_new_user_activity():
-    log.info("[.] Checking new user activity")
-    for user_id in get_user_id_list():
-        log.info(f"\t[.] Starting check for user {user_id}")
-        last_activity = get_last_user_activity(user_id)
-        log.info(f"\t[o] Previous last activity found {last_activity}")
-        activities, deleted_activities, max_activity_date = get_new_user_activity(
-            user_id, last_activity)
-        log.info(f"\t[o] Found {len(activities)} new user activities")
-        delete_user_anime_bulk(deleted_activities, user_id)
-        add_user_anime_bulk(activities, user_id)
-        update_last_user_activity(user_id, max_activity_date)
-        log.info(f"\t[.] Done new activity check for user {user_id}")
-    log.info("[+] Done checking new user activity")
+# Only one thread drains the outbox, or a batch could be sent twice
+OUTBOX_LOCK = threading.Lock()
 
+# Users onboarded by a background task right now, the daemon leaves them alone
+ONBOARDING_USERS: set[int] = set()
+ONBOARDING_LOCK = threading.Lock()
+ONBOARDING_PARALLEL_BATCHES = 4
+ONBOARDING_FRANCHISE_ROUNDS = 5
+
+# In memory only: after a restart the global feed is crawled on the first cycle,
+# an interrupted crawl is always resumed on the next one
+LAST_GLOBAL_FEED_AT = 0
 
-def get_anime(anime_id: int, update_anime=True) -> tuple[AnimeData, list[AnimeRelation]] | None:
-    global ANIME_TO_SEARCH
-    anime: AnimeData | None = get_anime_data(anime_id)
-    relations: list[AnimeRelation] | None = get_anime_relations(anime_id)
-    if anime is None or relations is None:
-        if anime_id not in ANIME_TO_SEARCH:
-            ANIME_TO_SEARCH.append(anime_id)
-        if not update_anime:
-            return None
-        datas = get_anime_data_from_id([anime_id])
-        if datas is None or len(datas) != 1:
-            log.error(f"[!] Unable to find anime data! {anime_id}")
-            return None
-        if not add_anime_bulk([datas[0][0]]):
-            log.error(f"[!] Error identifying anime {anime_id}")
-            return None
-        if not add_relations_bulk(datas[0][1]):
-            log.error(f"[!] Error identifying anime relations {anime_id}")
-        return datas[0]
 
-    return (anime, relations)
+async def write_user_activities(results: asyncio.Queue):
+    """Store the polled activities, everything that arrived while the previous write ran goes in one transaction"""
+    done = False
+    while not done:
+        activities: dict[int, tuple[list[int], list[int], int]] = {}
+        portion = await results.get()
+        while True:
+            if portion is None:
+                done = True
+                break
+            activities.update(portion)
+            if results.empty():
+                break
+            portion = results.get_nowait()
+        if len(activities) > 0:
+            await asyncio.to_thread(store_user_activities, activities)
 
 
-# We need to pass the parents parameter because of a misconfiguration on the
-# Anilist api. Sometimes two items are parent of each other (idk??), so we need
-# to check this in order to exit the deadlock
-def update_database_relations(anime_id: int, parents: list[int] = []) -> bool:
+async def poll_user_activity(users: list[tuple[int, int]]):
+    """
+    Poll the activities of the users, ACTIVITY_POLL_CONCURRENCY batched
+    requests at a time under the shared anilist rate limiter. A user that
+    takes longer than ACTIVITY_POLL_TIMEOUT_SECONDS is skipped and its
+    activities are picked up by the next pass
+    """
+    semaphore = asyncio.Semaphore(max(1, custom_config.ACTIVITY_POLL_CONCURRENCY))
+    results: asyncio.Queue = asyncio.Queue()
+
+    async def poll(portion: list[tuple[int, int]]):
+        async with semaphore:
+            try:
+                activities = await client.get_new_user_activity_portion(portion, custom_config.ACTIVITY_POLL_TIMEOUT_SECONDS)
+            except Exception as e:
+                log.error(f"[!] Could not get the activities of users {[u for u, _ in portion]}, skipping them: {e}")
+                return
+            await results.put(activities)
+
+    async with AsyncAniListClient() as client:
+        writer = asyncio.create_task(write_user_activities(results))
+        try:
+            await asyncio.gather(*[poll(p) for p in chunk_list(users, USERS_PER_ACTIVITY_QUERY)])
+        finally:
+            await results.put(None)
+            await writer
+
+
+def check_new_user_activity():
+    log.info("[.] Checking new user activity")
+    last_activities = get_last_user_activities()
+    users = [(user_id, last_activities[user_id])
+             for user_id in dict.fromkeys(get_user_id_list()) if user_id in last_activities]
+    asyncio.run(poll_user_activity(users))
+    log.info("[+] Done checking new user activity")
+
+
+def update_database_relations(anime_id: int, resolver: FranchiseResolver, fetch_queue: FetchQueue) -> bool | None:
+    """
+    Resolve the franchise of anime_id. Returns None when some members still
+    have to be fetched: they are added to the fetch queue and the franchise
+    is resolved after the next flush.
+    """
     log.debug(f"[.] Updating database relations for anime {anime_id}")
-    res = get_anime(anime_id, False)
-    if res is None:
-        log.error(f"[!] Could not update anime database, can't find anime {str(anime_id)}!")
+    missing = resolver.missing(anime_id)
+    not_found = [i for i in missing if i in fetch_queue.not_found]
+    if len(not_found) > 0:
+        log.error(
+            f"[!] Could not update anime database, anilist did not return anime {not_found}!")
         return False
-    for rel in res[1]:
-        if rel.relation_type == "PARENT":
-            if rel.related_anilist_id in parents:
-                log.error(
-                    f"[!] Anilist api has an error, two anime ({anime_id} and {rel.related_anilist_id}) are parent of each other"
-                )
-                return False
-            success = update_database_relations(rel.related_anilist_id, parents + [rel.related_anilist_id])
-            log.debug(
-                f"[!] Done updating database relations for anime {anime_id}, has parents"
-            )
-            return success
+    if len(missing) > 0:
+        log.debug(
+            f"[i] Waiting for {len(missing)} missing anime of the franchise of {anime_id}")
+        fetch_queue.add(missing)
+        return None
 
-    anime_to_check: list[int] = [anime_id]
-    anime_checked: dict[int, bool] = {}
-    main_story_anime: list[AnimeData] = []
-    spinoff_anime: list[AnimeData] = []
-    has_parents = False
-
-    while len(anime_to_check) > 0:
-        current_id = anime_to_check.pop()
-        if current_id in anime_checked and anime_checked[current_id] is True:
-            continue
-        res = get_anime(current_id, True)
-        if res is None:
-            log.error(f"[!] Could not update anime database, can't find anime {str(current_id)}!")
-            return False
-        has_parents = False
-        for rel in res[1]:
-            if rel.relation_type == "CHARACTER":
-                continue
-            if rel.relation_type == "PARENT":
-                has_parents = True
-                continue
-            if rel.related_anilist_id in anime_checked and anime_checked[rel.related_anilist_id]:
-                continue
-            anime_to_check.append(rel.related_anilist_id)
-
-        if has_parents:
-            if current_id not in spinoff_anime:
-                spinoff_anime.append(res[0])
-        else:
-            if current_id not in main_story_anime:
-                main_story_anime.append(res[0])
-        anime_checked[res[0].id] = True
-    anime_data_list = main_story_anime+spinoff_anime
-    search_min_list = main_story_anime if len(
-        main_story_anime) > 0 else spinoff_anime
-    min_date = search_min_list[0].start_date
-    min_id = search_min_list[0].id
-    for d in search_min_list:
-        if d.start_date < min_date:
-            min_date = d.start_date
-            min_id = d.id
-
-    for a in anime_data_list:
-        update_anime_related_to(a.id, min_id)
+    update_anime_related_to_bulk(
+        resolver.franchise_root(anime_id), resolver.component(anime_id))
     log.debug(f"[+] Done updating database relations for anime {anime_id}")
     return True
 
 
-def update_anime_database():
-    global ANIME_TO_SEARCH
-    get_new_updates(get_last_updated_at(), True)
-    offset = 0
-    previous_id = -1
+def flush_fetch_queue(resolver: FranchiseResolver, fetch_queue: FetchQueue, full_batches_only: bool = False) -> int:
+    anime_list, relations = fetch_queue.flush(full_batches_only)
+    resolver.add(anime_list, relations)
+    return len(anime_list)
+
+
+def resolve_pending_relations(resolver: FranchiseResolver, fetch_queue: FetchQueue):
+    """
+    Sweep the relation resolution queue in batches. Franchises with members
+    that are not stored yet wait for the fetch queue and are retried by the
+    next sweep, anime that can't be resolved are backed off.
+    """
+    log.info("[.] Resolving pending anime relations")
+    resolved_ids: set[int] = set()
+    failed_franchises: set[int] = set()
     while True:
-        related_id = find_next_unrelated_anime(offset)
-        previous_id = related_id
-        if related_id is None:
-            if len(ANIME_TO_SEARCH) == 0:
-                return
-            datas = get_anime_data_from_id(ANIME_TO_SEARCH)
-            if datas is None:
-                log.error(f"[!] Unable to find anime data! {id}")
-                return None
-            anime_list: list[AnimeData] = []
-            relations: list[AnimeRelation] = []
-            for v in datas:
-                anime_list.append(v[0])
-                relations += v[1]
-            if not add_anime_bulk(anime_list):
-                log.error(f"[!] Error identifying anime {id}")
-                return None
-            if not add_relations_bulk(relations):
-                log.error(f"[!] Error identifying anime relations {id}")
-            ANIME_TO_SEARCH = []
-            continue
-        # This could happen because there is an error in the anilist api
-        # And some relations are missing. So even though the update relations
-        # returns a success, the unrelated anime remains the same
-        if previous_id == related_id:
-            offset += 1
-            continue
-        success = update_database_relations(related_id)
-        if not success:
-            offset += 1
+        waiting = 0
+        last_id = -1
+        now = int(time.time())
+        while True:
+            batch = get_pending_relation_resolutions(
+                now, last_id, RELATION_QUEUE_BATCH_SIZE)
+            if len(batch) == 0:
+                break
+            last_id = batch[-1]
+            failed: list[int] = []
+            for anime_id in batch:
+                if anime_id in resolved_ids:
+                    continue
+                # One failure is enough for the whole franchise in this pass
+                if resolver.find(anime_id) in failed_franchises:
+                    failed.append(anime_id)
+                    continue
+                success = update_database_relations(
+                    anime_id, resolver, fetch_queue)
+                if success is None:
+                    waiting += 1
+                elif success:
+                    resolved_ids.update(resolver.component(anime_id))
+                else:
+                    failed_franchises.add(resolver.find(anime_id))
+                    failed.append(anime_id)
+            if len(failed) > 0:
+                postpone_relation_resolutions(
+                    failed, now, RELATION_RETRY_BASE_SECONDS, RELATION_RETRY_MAX_SECONDS, "franchise could not be resolved")
+            flush_fetch_queue(resolver, fetch_queue, True)
+        if waiting == 0:
+            break
+        if flush_fetch_queue(resolver, fetch_queue) == 0 and len(fetch_queue) > 0:
+            log.error(
+                f"[!] Could not fetch the missing anime, {waiting} franchises will be retried on the next cycle")
+            break
+    log.info(
+        f"[+] Done resolving pending anime relations (resolved: {len(resolved_ids)}, postponed franchises: {len(failed_franchises)})")
 
 
-def process_users_with_missing_anilist_id():
-    users = get_users_missing_ani_id()
-    for telegram_id, anilist_username in users:
-        anilist_id = get_anilist_id_from_username(anilist_username)
+async def fetch_new_updates(state: SyncState) -> bool:
+    """Crawl the anilist update feed, storing each page while the next one is downloaded. Returns whether the crawl went through"""
+    async with AsyncAniListClient() as client:
+        return await client.get_new_updates(state, True) is not None
+
+
+def is_global_feed_due(state: SyncState, now: int) -> bool:
+    if custom_config.REFRESH_MODE == "feed" or state.crawl_watermark is not None:
+        return True
+    return now - LAST_GLOBAL_FEED_AT >= custom_config.GLOBAL_FEED_INTERVAL_SECONDS
+
+
+def queue_watched_anime_refresh(fetch_queue: FetchQueue):
+    """Targeted refresh: the watched anime are fetched by id instead of waiting for the global feed"""
+    anime_ids = get_watched_refresh_ids()
+    log.info(f"[.] Refreshing {len(anime_ids)} watched anime")
+    fetch_queue.add(anime_ids)
+
+
+def update_anime_database():
+    global LAST_GLOBAL_FEED_AT
+    now = int(time.time())
+    state = get_sync_state(UPDATE_FEED_SYNC_NAME)
+    if is_global_feed_due(state, now):
+        # A failed crawl is tried again on the next cycle, not after the whole interval
+        if asyncio.run(fetch_new_updates(state)):
+            LAST_GLOBAL_FEED_AT = now
+    resolver = FranchiseResolver()
+    fetch_queue = FetchQueue()
+    if custom_config.REFRESH_MODE == "targeted":
+        queue_watched_anime_refresh(fetch_queue)
+    flush_fetch_queue(resolver, fetch_queue)
+    resolve_pending_relations(resolver, fetch_queue)
+
+
+def prepare_onboarding(state: OnboardingState, fetch_queue: FetchQueue) -> bool:
+    """
+    Run the onboarding steps that come before linking the user: find its
+    anilist id, then its watched anime, whose missing ones are queued for
+    fetching. Each step is saved, an interrupted onboarding resumes at the
+    step it stopped at
+    """
+    if state.step == "resolve_id":
+        anilist_id = get_anilist_id_from_username(state.anilist_username)
         if not anilist_id:
             log.error(
-                f"[!] Could not find anilist_id for username {anilist_username}")
-            continue
-
-        anime_ids = get_watched_anime(anilist_username)
+                f"[!] Could not find anilist_id for username {state.anilist_username}")
+            return False
+        state.anilist_id, state.step = anilist_id, "fetch_list"
+        save_onboarding_state(state)
+    if state.step == "fetch_list":
+        anime_ids = get_watched_anime(state.anilist_username)
         if not anime_ids:
             log.warning(
-                f"[!] No watched anime found for user {anilist_username}")
+                f"[!] No watched anime found for user {state.anilist_username}")
+            return False
+        state.anime_ids, state.step = anime_ids, "fetch_anime"
+        with connection(immediate=True):
+            fetch_queue.add(get_missing_anime_ids(anime_ids))
+            save_onboarding_state(state)
+    elif state.step == "fetch_anime":
+        # onboard_user imports the anime without queueing them, whatever it
+        # did not store before being interrupted is queued here
+        fetch_queue.add(get_missing_anime_ids(state.anime_ids))
+    return True
+
+
+def process_users_with_missing_anilist_id():
+    with ONBOARDING_LOCK:
+        users = [u for u in get_users_missing_ani_id() if u[0] not in ONBOARDING_USERS]
+    if len(users) == 0:
+        return
+    fetch_queue = FetchQueue()
+    states: list[OnboardingState] = []
+    for telegram_id, anilist_username in users:
+        try:
+            state = get_onboarding_state(telegram_id, anilist_username)
+            if prepare_onboarding(state, fetch_queue):
+                states.append(state)
+        except Exception as e:
+            log.error(
+                f"[!] Could not prepare the onboarding of user {anilist_username}, it is resumed on the next cycle: {e}")
+    # The missing anime of every user are fetched together, in full batches
+    fetch_queue.flush()
+    for state in states:
+        if any(anime_id in fetch_queue.pending for anime_id in state.anime_ids):
+            log.error(
+                f"[!] Could not fetch the anime of user {state.anilist_username}, the onboarding is resumed on the next cycle")
             continue
-        anime_to_get: list[int] = []
-        for anime_id in anime_ids:
-            if not check_anime_in_db(anime_id):
-                anime_to_get.append(anime_id)
-        if len(anime_to_get) > 0:
-            anime_data = get_anime_data_from_id(anime_to_get)
-            if anime_data and len(anime_data) > 0:
-                anime_list: list[AnimeData] = []
-                relations_list: list[AnimeRelation] = []
-                for v in anime_data:
-                    anime_list.append(v[0])
-                    relations_list += v[1]
-                add_anime_bulk(anime_list)
-                add_relations_bulk(relations_list)
-        update_user_anilist_id(telegram_id, anilist_id)
-        add_user_anime_bulk(anime_ids, anilist_id)
-        log.info(
-            f"[+] Processed user {anilist_username} (anilist_id={anilist_id})")
-
-
-def notify_users_anime_updates():
+        try:
+            finished = finish_onboarding(state)
+        except Exception as e:
+            log.error(
+                f"[!] Could not link user {state.anilist_username}, the onboarding is resumed on the next cycle: {e}")
+            continue
+        if finished:
+            log.info(
+                f"[+] Processed user {state.anilist_username} (anilist_id={state.anilist_id})")
+
+
+def store_anime_data(datas: list[tuple[AnimeData, list[AnimeRelation]]]):
+    with connection():
+        add_anime_bulk([v[0] for v in datas])
+        add_relations_bulk([r for v in datas for r in v[1]])
+
+
+async def import_anime(client: AsyncAniListClient, anime_ids: list[int],
+                       report: Callable[[int], Awaitable[None]] | None = None) -> list[tuple[AnimeData, list[AnimeRelation]]] | None:
+    """
+    Fetch and store the anime, ONBOARDING_PARALLEL_BATCHES requests at a
+    time, reporting how many are done after each group. None if a request failed
+    """
+    datas: list[tuple[AnimeData, list[AnimeRelation]]] = []
+    for i, group in enumerate(chunk_list(anime_ids, MAX_ANIME_PER_QUERY * ONBOARDING_PARALLEL_BATCHES)):
+        group_datas = await client.get_anime_data_from_id(group)
+        if group_datas is None:
+            await asyncio.to_thread(queue_anime_fetches, anime_ids[i * MAX_ANIME_PER_QUERY * ONBOARDING_PARALLEL_BATCHES:])
+            return None
+        await asyncio.to_thread(store_anime_data, group_datas)
+        datas += group_datas
+        if report is not None:
+            await report(min(len(anime_ids), (i + 1) * MAX_ANIME_PER_QUERY * ONBOARDING_PARALLEL_BATCHES))
+    return datas
+
+
+async def expand_franchises(client: AsyncAniListClient, datas: list[tuple[AnimeData, list[AnimeRelation]]]):
+    """
+    Fetch the related anime the imported ones are missing, then resolve their
+    franchises. Franchises still incomplete after ONBOARDING_FRANCHISE_ROUNDS
+    are left in the relation resolution queue for the daemon
+    """
+    resolver = await asyncio.to_thread(FranchiseResolver)
+    resolver.add([v[0] for v in datas], [r for v in datas for r in v[1]])
+    imported_ids = [v[0].id for v in datas]
+    not_found: set[int] = set()
+    for _ in range(ONBOARDING_FRANCHISE_ROUNDS):
+        missing = list({m for anime_id in imported_ids for m in resolver.missing(anime_id) if m not in not_found})
+        if len(missing) == 0:
+            break
+        log.info(f"[.] Fetching {len(missing)} related anime of the imported franchises")
+        related = await import_anime(client, missing)
+        if related is None:
+            break
+        resolver.add([v[0] for v in related], [r for v in related for r in v[1]])
+        not_found.update(set(missing) - {v[0].id for v in related})
+    franchises = {resolver.find(anime_id) for anime_id in imported_ids
+                  if len([m for m in resolver.missing(anime_id) if m not in not_found]) == 0}
+
+    def resolve():
+        for root in franchises:
+            update_anime_related_to_bulk(resolver.franchise_root(root), resolver.component(root))
+    await asyncio.to_thread(resolve)
+
+
+async def onboard_user(telegram_id: int, anilist_username: str,
+                       report: Callable[[int, int], Awaitable[None]]) -> int | None:
+    """
+    Onboard a new user right away instead of waiting for the daemon cycle:
+    find its anilist id and list, import the missing anime in parallel
+    batches reporting (imported, total) as it goes, expand their franchises
+    and link the user. Returns the number of anime followed, None if the
+    onboarding did not complete (the daemon resumes it from the saved step)
+    """
+    with ONBOARDING_LOCK:
+        ONBOARDING_USERS.add(telegram_id)
+    try:
+        state = get_onboarding_state(telegram_id, anilist_username)
+        # A new user is waiting on this, its requests go before the daemon's
+        async with AsyncAniListClient(priority=True) as client:
+            if state.step == "resolve_id":
+                anilist_id = await client.get_anilist_id_from_username(anilist_username)
+                if not anilist_id:
+                    log.error(f"[!] Could not find anilist_id for username {anilist_username}")
+                    return None
+                state.anilist_id, state.step = anilist_id, "fetch_list"
+                save_onboarding_state(state)
+            if state.step == "fetch_list":
+                anime_ids = await client.get_watched_anime(anilist_username)
+                if not anime_ids:
+                    log.warning(f"[!] No watched anime found for user {anilist_username}")
+                    return None
+                state.anime_ids, state.step = anime_ids, "fetch_anime"
+                save_onboarding_state(state)
+            missing = get_missing_anime_ids(state.anime_ids)
+            already_stored = len(state.anime_ids) - len(missing)
+            await report(already_stored, len(state.anime_ids))
+
+            async def report_import(done: int):
+                await report(already_stored + done, len(state.anime_ids))
+            datas = await import_anime(client, missing, report_import)
+            if datas is None:
+                log.error(
+                    f"[!] Could not import the anime of user {anilist_username}, the onboarding is resumed on the next cycle")
+                return None
+            await expand_franchises(client, datas)
+        if not await asyncio.to_thread(finish_onboarding, state):
+            return None
+        log.info(f"[+] Onboarded user {anilist_username} (anilist_id={state.anilist_id})")
+        return len(state.anime_ids)
+    finally:
+        with ONBOARDING_LOCK:
+            ONBOARDING_USERS.discard(telegram_id)
+
+
+def notify_users_anime_updates(anime_ids: list[int] | None = None):
+    """Queue the new episode notifications, the watermarks move in the same transaction"""
     log.info("[.] Checking for new anime episodes to notify users (optimized)")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT ua.notified_episode, u.telegram_id, a.id, ua.anilist_user_id,
-            COALESCE(a.latest_aired_episode, a.episodes, 0) as max_ep
-        FROM user_anime ua
-        JOIN users u ON ua.anilist_user_id = u.anilist_id
-        JOIN anime a ON ua.anime_id = a.id
-        WHERE u.telegram_id != -1
-          AND COALESCE(a.latest_aired_episode, a.episodes, 0) > COALESCE(ua.notified_episode, 0)
-    """)
-    rows = cursor.fetchall()
-    if rows and len(rows) > 0:
-        for notified_episode, telegram_id, anime_id, anilist_user_id, max_ep in rows:
+    # The targeted anime are matched SQL_CHUNK_SIZE at a time, under the sqlite variable limit
+    chunks: list[list[int] | None] = [None] if anime_ids is None else chunk_list(anime_ids, SQL_CHUNK_SIZE)
+    # The rows are read under the write lock, so two threads can't queue the same episode
+    with connection(immediate=True) as conn:
+        cursor = conn.cursor()
+        rows = []
+        for chunk in chunks:
+            anime_filter = "" if chunk is None else f"AND a.id IN ({','.join('?' * len(chunk))})"
+            cursor.execute(f"""
+                SELECT ua.notified_episode, u.telegram_id, a.id, ua.anilist_user_id,
+                    COALESCE(a.latest_aired_episode, a.episodes, 0) as max_ep
+                FROM user_anime ua
+                JOIN users u ON ua.anilist_user_id = u.anilist_id
+                JOIN anime a ON ua.anime_id = a.id
+                WHERE u.telegram_id != -1 AND u.inactive_at IS NULL
+                  AND COALESCE(a.latest_aired_episode, a.episodes, 0) > COALESCE(ua.notified_episode, 0)
+                  {anime_filter}
+                ORDER BY a.id, ua.anilist_user_id
+            """, chunk or [])
+            rows += cursor.fetchall()
+        # One event per anime episode, a negative notified_episode means the
+        # user does not want to be notified
+        events: dict[str, tuple[NotificationEvent, list[int]]] = {}
+        for notified_episode, telegram_id, anime_id, _, max_ep in rows:
             if notified_episode > -1:
-                anime = get_anime_data(anime_id)
-                if not anime or anime is None:
+                key = f"episode_update:{anime_id}:{max_ep}"
+                events.setdefault(key, (NotificationEvent(key, anime_id, "episode_update"), []))[1].append(telegram_id)
+        enqueue_notifications(list(events.values()))
+        # One row per linked telegram account, one watermark per user_anime row
+        cursor.executemany(
+            "UPDATE user_anime SET notified_episode=? WHERE anilist_user_id=? AND anime_id=?",
+            list(dict.fromkeys((max_ep, anilist_user_id, anime_id)
+                               for _, _, anime_id, anilist_user_id, max_ep in rows))
+        )
+    log.info(
+        f"[+] Done notifying users about new anime episodes, queued {len(rows)} updates")
+
+
+def drain_notification_outbox():
+    """Send the queued notifications, storing the outcome of each batch in one transaction"""
+    with OUTBOX_LOCK:
+        while True:
+            now = int(time.time())
+            entries = get_pending_notifications(now, OUTBOX_BATCH_SIZE, custom_config.DIGEST_WINDOW_SECONDS)
+            if len(entries) == 0:
+                break
+            started_at = time.time()
+            sendable: list[tuple[OutboxEntry, NotificationEvent]] = []
+            digests: dict[int, list[tuple[OutboxEntry, NotificationEvent]]] = {}
+            failed: list[tuple[int, str]] = []
+            for entry, event, digest in entries:
+                if event is None:
                     log.warning(
-                        f"[!] Could not find anime with id {anime_id} for notification")
-                send_telegram_notification(
-                    telegram_id, anime, "episode_update")
-            cursor.execute(
-                "UPDATE user_anime SET notified_episode=? WHERE anilist_user_id=? AND anime_id=?",
-                (max_ep, anilist_user_id, anime_id)
+                        f"[!] Could not find anime with id {entry.anime_id} for notification")
+                    failed.append((entry.id, "anime not found"))
+                    continue
+                if digest:
+                    digests.setdefault(entry.telegram_id, []).append((entry, event))
+                else:
+                    sendable.append((entry, event))
+            file_ids = get_cover_file_ids([entry.anime_id for entry, event, _ in entries if event is not None])
+            results = dispatch_notifications(
+                [TelegramNotification(entry.telegram_id, event) for entry, event in sendable],
+                [[TelegramNotification(entry.telegram_id, event) for entry, event in digest_entries]
+                 for digest_entries in digests.values()],
+                file_ids
             )
-            conn.commit()
-    conn.close()
-    log.info(
-        f"[+] Done notifying users about new anime episodes, notified {len(rows)} updates")
+            # The results follow the single notifications and then the digests
+            sendable += [e for digest_entries in digests.values() for e in digest_entries]
+            save_cover_file_ids([(event.anime_id, event.photo, result.file_id)
+                                 for (_, event), result in zip(sendable, results) if result.file_id], int(time.time()))
+            delivered_ids: list[int] = []
+            retry: list[tuple[int, str]] = []
+            unreachable: dict[int, str] = {}
+            for (entry, _), result in zip(sendable, results):
+                if result.delivered:
+                    delivered_ids.append(entry.id)
+                elif result.retryable:
+                    retry.append((entry.id, result.error or ""))
+                else:
+                    failed.append((entry.id, result.error or ""))
+                    if result.chat_unreachable:
+                        unreachable[entry.telegram_id] = result.error or ""
+            finished = record_notification_results(delivered_ids, retry, failed, int(time.time()),
+                                                   OUTBOX_RETRY_BASE_SECONDS, OUTBOX_RETRY_MAX_SECONDS,
+                                                   OUTBOX_MAX_ATTEMPTS, started_at)
+            deactivate_telegram_users(list(unreachable.items()), int(time.time()))
+            for stats in finished:
+                log.info(
+                    f"[i] Event {stats.event_key} done: {stats.delivered}/{stats.recipients} delivered, {stats.failed} failed in {stats.wall_seconds:.1f} seconds")
+            log.info(
+                f"[+] Outbox batch done (delivered: {len(delivered_ids)}, retry: {len(retry)}, failed: {len(failed)})")
+            if len(entries) < OUTBOX_BATCH_SIZE:
+                break
+
+
+def refresh_aired_anime():
+    """Refresh the watched anime whose next episode just aired and notify their new episodes"""
+    now = int(time.time())
+    anime_ids = get_due_airing_anime(now)
+    if len(anime_ids) == 0:
+        return
+    log.info(f"[.] Refreshing {len(anime_ids)} anime with a newly aired episode")
+    datas = get_anime_data_from_id(anime_ids)
+    if datas is None:
+        log.error("[!] Could not refresh the aired anime")
+    else:
+        add_anime_bulk([v[0] for v in datas])
+        add_relations_bulk([r for v in datas for r in v[1]])
+    # Anilist may not have moved to the next episode yet, try again later
+    postpone_airing_checks(anime_ids, now, now + AIRING_RECHECK_SECONDS)
+    notify_users_anime_updates(anime_ids)
+    log.info("[+] Done refreshing aired anime")
 
 
 def main_daemon_job():
@@ -0,0 +1,125 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+import custom_config
+from custom_logging import set_logger
+
+log = set_logger("DB_CONNECTION")
+
+# Each profile is applied once, when the thread opens its connection.
+# busy_timeout is in milliseconds, a negative cache_size is in KiB and
+# mmap_size is in bytes.
+PRAGMA_PROFILES: dict[str, dict[str, int | str]] = {
+    "default": {
+        "busy_timeout": 10000,
+        "synchronous": "NORMAL",
+        "cache_size": -16000,
+        "mmap_size": 64 * 1024 * 1024,
+    },
+    "safe": {
+        "busy_timeout": 30000,
+        "synchronous": "FULL",
+        "cache_size": -8000,
+        "mmap_size": 0,
+    },
+    "fast": {
+        "busy_timeout": 10000,
+        "synchronous": "NORMAL",
+        "cache_size": -64000,
+        "mmap_size": 256 * 1024 * 1024,
+    },
+}
+
+_local = threading.local()
+
+
+def get_profile() -> dict[str, int | str]:
+    if custom_config.DATABASE_PROFILE not in PRAGMA_PROFILES:
+        log.warning(
+            f"[!] Unknown database profile {custom_config.DATABASE_PROFILE}, using default")
+        return PRAGMA_PROFILES["default"]
+    return PRAGMA_PROFILES[custom_config.DATABASE_PROFILE]
+
+
+def open_connection() -> sqlite3.Connection:
+    profile = get_profile()
+    conn = sqlite3.connect(
+        custom_config.DATABASE_PATH,
+        timeout=int(profile["busy_timeout"]) / 1000
+    )
+    conn.execute("PRAGMA journal_mode=WAL;")
+    for pragma in ["busy_timeout", "synchronous", "cache_size", "mmap_size"]:
+        conn.execute(f"PRAGMA {pragma}={profile[pragma]};")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    log.debug(
+        f"[+] Opened database connection for thread {threading.current_thread().name}")
+    return conn
+
+
+def get_connection() -> sqlite3.Connection:
+    """Return the connection owned by the calling thread, opening it on first use"""
+    conn: sqlite3.Connection | None = getattr(_local, "conn", None)
+    if conn is None:
+        conn = open_connection()
+        _local.conn = conn
+        _local.depth = 0
+    return conn
+
+
+def close_connection():
+    conn: sqlite3.Connection | None = getattr(_local, "conn", None)
+    if conn is None:
+        return
+    conn.close()
+    _local.conn = None
+    _local.depth = 0
+
+
+@contextmanager
+def connection(immediate: bool = False) -> Iterator[sqlite3.Connection]:
+    """
+    Borrow the thread connection for a unit of work.
+
+    Blocks can be nested: only the outermost one commits on success or
+    rolls back on error, so a helper called from inside another helper
+    joins the caller's transaction instead of committing it halfway. A
+    nested block is a savepoint: when it fails, only its own statements are
+    rolled back, so a helper that catches its own error leaves nothing
+    half-applied for the outer block to commit. The transaction opened for
+    nested blocks holds the write lock from its start, so concurrent
+    writers wait for each other instead of failing. An outermost block
+    that reads before it writes should ask for immediate to do the same.
+    """
+    conn = get_connection()
+    depth = _local.depth + 1
+    savepoint = None
+    if depth == 1 and immediate and not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    elif depth > 1:
+        # Releasing a savepoint that opened the transaction would commit it.
+        # IMMEDIATE takes the write lock up front: a deferred transaction that
+        # reads and then writes gets SQLITE_BUSY without waiting busy_timeout
+        # when another thread committed in between
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        savepoint = f"nested_{depth}"
+        conn.execute(f"SAVEPOINT {savepoint}")
+    _local.depth = depth
+    try:
+        yield conn
+    except BaseException:
+        if savepoint is not None:
+            conn.execute(f"ROLLBACK TO {savepoint}")
+            conn.execute(f"RELEASE {savepoint}")
+        else:
+            conn.rollback()
+        raise
+    else:
+        if savepoint is not None:
+            conn.execute(f"RELEASE {savepoint}")
+        else:
+            conn.commit()
+    finally:
+        _local.depth -= 1
@@ -1,357 +1,412 @@
-import sqlite3
-import custom_config
-from custom_dataclasses import AnimeData, AnimeRelation
+import json
+import time
+
+from custom_dataclasses import AnimeData, AnimeRelation, EventStats, NotificationEvent, OnboardingState, OutboxEntry, RelationsBulkResult, SyncState
 from custom_logging import set_logger
+from db_connection import connection
+from db_migrations import run_migrations
 
-from utils import send_telegram_notification
+from utils import chunk_list, render_notification_event
 
 log = set_logger("DATABASE_INTERACTOR")
 
 NO_OLD_DATA_FOUND_STATUS = "NO_OLD_DATA_FOUND"
-
-
-def add_column(table_name, column_name, column_type):
-    log.info(f"\t\t[.] Adding column {column_name} on table {table_name}")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cur = conn.cursor()
-    cur.execute(f"PRAGMA table_info({table_name});")
-    columns = [row[1] for row in cur.fetchall()]
-
-    if column_name not in columns:
-        cur.execute(
-            f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type};")
-        conn.commit()
-        log.info(
-            f"\t\t[+] Column {column_name} on table {table_name} added successfully")
-    else:
-        log.info(
-            f"\t\t[-] Column {column_name} on table {table_name} was already present")
-
-    conn.close()
-
-
-def run_migrations():
-    """Run all database migrations in order"""
-    log.info("\t[.] Running migrations commands")
-    add_column("anime", "updated_at", "INTEGER DEFAULT 0")
-    add_column("anime_relations", "date_update_found", "INTEGER DEFAULT 0")
-    add_column("users", "telegram_id", "INTEGER DEFAULT -1")
-    add_column("anime", "start_date", "INTEGER DEFAULT 0")
-    add_column("anime", "old_status", "TEXT")
-    add_column("users", "anilist_username", "TEXT")
-    log.info("\t[-] Done running migrations")
+SQL_CHUNK_SIZE = 500
+# Anilist moves nextAiringEpisode forward a few minutes after the airing time
+AIRING_REFRESH_DELAY_SECONDS = 5 * 60
 
 
 def init_db():
     log.info("[.] Initializing database")
-    log.info("\t[.] Checking and adding tables")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_handle TEXT,
-            anilist_id INTEGER,
-            last_activity_checked INTEGER DEFAULT 0
-        );
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS anime (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT,
-            type TEXT,
-            status TEXT,
-            cover TEXT,
-            episodes INTEGER,
-            latest_aired_episode INTEGER,
-            related_to TEXT DEFAULT ''
-        );
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_anime (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            anilist_user_id INTEGER,
-            anime_id INTEGER,
-            notified_episode INTEGER DEFAULT 0,
-            UNIQUE(anilist_user_id, anime_id)
-        );
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS anime_relations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            primary_anilist_id INTEGER,
-            related_anilist_id INTEGER,
-            relation_type TEXT,
-            UNIQUE(primary_anilist_id, related_anilist_id)
-        );
-    """)
-    conn.commit()
-    conn.close()
-    log.info("\t[-] Done checking and adding tables")
     run_migrations()
     log.info("[-] Done initializing database")
 
 
 def add_anime_bulk(anime_list: list[AnimeData]) -> bool:
     log.info(f"[.] Adding bulk anime list to db (length: {len(anime_list)})")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
     try:
-        for anime in anime_list:
-            old_status = NO_OLD_DATA_FOUND_STATUS
-            related_to = ''
-            cursor.execute(
-                """SELECT status, updated_at, related_to FROM anime WHERE id = ?""",
-                (anime.id,),
+        with connection() as conn:
+            cursor = conn.cursor()
+            # A single upsert per page: rows older than the stored one are left
+            # untouched and the previous status is moved into old_status (SET
+            # reads the pre-update row values)
+            cursor.executemany(
+                """
+                INSERT INTO anime (
+                    id, title, type, status, cover, episodes, latest_aired_episode, updated_at, start_date, old_status
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    title=excluded.title,
+                    type=excluded.type,
+                    old_status=anime.status,
+                    status=excluded.status,
+                    cover=excluded.cover,
+                    episodes=excluded.episodes,
+                    latest_aired_episode=excluded.latest_aired_episode,
+                    updated_at=excluded.updated_at,
+                    start_date=excluded.start_date
+                WHERE excluded.updated_at >= anime.updated_at
+                """,
+                [
+                    (
+                        anime.id,
+                        anime.title,
+                        anime.type,
+                        anime.status,
+                        anime.cover,
+                        anime.episodes,
+                        anime.latest_aired_episode,
+                        anime.updated_date,
+                        anime.start_date,
+                        NO_OLD_DATA_FOUND_STATUS
+                    )
+                    for anime in anime_list
+                ]
             )
-            res = cursor.fetchall()
-            if len(res) > 0:
-                if res[0][1] > anime.updated_date:
-                    log.debug(
-                        f"[?] Did not update anime {anime.id}: update date {anime.updated_date} < current date {res[0][0]}")
-                    continue
-                related_to = res[0][2]
-                old_status = res[0][0]
-
-            cursor.execute(
+            skipped = len(anime_list) - cursor.rowcount
+            if skipped > 0:
+                log.debug(
+                    f"[?] Did not update {skipped} anime: stored update date is newer")
+            # Same freshness rule for the schedule: only the anime whose row
+            # now holds this update date write it
+            cursor.executemany(
                 """
-                INSERT OR REPLACE INTO anime (
-                    id, title, type, status, cover, episodes, latest_aired_episode, updated_at, start_date, old_status, related_to
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                INSERT INTO airing_schedule (anime_id, episode, airing_at, next_check_at)
+                SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM anime WHERE id = ? AND updated_at = ?)
+                ON CONFLICT(anime_id) DO UPDATE SET
+                    episode=excluded.episode,
+                    airing_at=excluded.airing_at,
+                    next_check_at=excluded.next_check_at
+                WHERE excluded.airing_at != airing_schedule.airing_at
                 """,
-                (
-                    anime.id,
-                    anime.title,
-                    anime.type,
-                    anime.status,
-                    anime.cover,
-                    anime.episodes,
-                    anime.latest_aired_episode,
-                    anime.updated_date,
-                    anime.start_date,
-                    old_status,
-                    related_to
-                )
+                [
+                    (
+                        anime.id,
+                        (anime.latest_aired_episode or 0) + 1,
+                        anime.next_episode_airing_at,
+                        anime.next_episode_airing_at + AIRING_REFRESH_DELAY_SECONDS,
+                        anime.id,
+                        anime.updated_date
+                    )
+                    for anime in anime_list if anime.next_episode_airing_at > 0
+                ]
+            )
+            cursor.executemany(
+                """
+                DELETE FROM airing_schedule
+                WHERE anime_id = ? AND EXISTS (SELECT 1 FROM anime WHERE id = ? AND updated_at = ?)
+                """,
+                [
+                    (anime.id, anime.id, anime.updated_date)
+                    for anime in anime_list if anime.next_episode_airing_at <= 0
+                ]
+            )
+            # A new cover makes the cached Telegram upload of the old one useless
+            cursor.executemany(
+                """
+                DELETE FROM telegram_file_cache
+                WHERE anime_id = ? AND cover_url != ? AND EXISTS (SELECT 1 FROM anime WHERE id = ? AND updated_at = ?)
+                """,
+                [
+                    (anime.id, anime.cover, anime.id, anime.updated_date)
+                    for anime in anime_list
+                ]
             )
-        conn.commit()
+            for chunk in chunk_list([anime.id for anime in anime_list], SQL_CHUNK_SIZE):
+                cursor.execute(
+                    f"""
+                    INSERT OR IGNORE INTO relation_resolution_queue (anime_id)
+                    SELECT id FROM anime a WHERE id IN ({",".join("?" * len(chunk))})
+                    AND NOT EXISTS (SELECT 1 FROM franchise_member fm WHERE fm.anime_id = a.id)
+                    """,
+                    chunk
+                )
         log.info("[+] Bulk insert successful")
     except Exception as e:
         log.error(f"[!] Error during bulk insert: {e}")
         return False
-    finally:
-        conn.close()
     return True
 
 
-def add_relations_bulk(relations_list: list[AnimeRelation]) -> bool:
+def add_relations_bulk(relations_list: list[AnimeRelation]) -> RelationsBulkResult | None:
     log.info(
         f"[.] Adding bulk relations list to db (length: {len(relations_list)})")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
+    result = RelationsBulkResult()
+    relations: dict[tuple[int, int], AnimeRelation] = {}
+    for relation in relations_list:
+        relations[(relation.primary_anilist_id, relation.related_anilist_id)] = relation
+    result.skipped = len(relations_list) - len(relations)
     try:
-        for relation in relations_list:
-            cursor.execute(
-                """SELECT date_update_found, relation_type FROM anime_relations WHERE primary_anilist_id=? AND related_anilist_id = ?""",
-                (relation.primary_anilist_id, relation.related_anilist_id),
-            )
-            res = cursor.fetchall()
-            if len(res) > 0 and len(res[0]) == 2:
-                if res[0][0] >= relation.date_update_found:
-                    log.debug(
-                        f"[?] Did not update relation {relation.primary_anilist_id}->{relation.related_anilist_id}: update_date {relation.date_update_found} > {res[0][0]})")
-                    continue
-                if res[0][1] == relation.relation_type:
-                    continue
-            cursor.execute(
+        with connection() as conn:
+            cursor = conn.cursor()
+            existing: dict[tuple[int, int], tuple[int, str]] = {}
+            primary_ids = list(set(r.primary_anilist_id for r in relations.values()))
+            for chunk in chunk_list(primary_ids, SQL_CHUNK_SIZE):
+                cursor.execute(
+                    f"""
+                    SELECT primary_anilist_id, related_anilist_id, date_update_found, relation_type
+                    FROM anime_relations WHERE primary_anilist_id IN ({",".join("?" * len(chunk))})
+                    """,
+                    chunk
+                )
+                for primary_id, related_id, date_update_found, relation_type in cursor.fetchall():
+                    existing[(primary_id, related_id)] = (date_update_found or 0, relation_type)
+
+            to_write: list[AnimeRelation] = []
+            changed_primaries: set[int] = set()
+            for key, relation in relations.items():
+                if key in existing:
+                    if existing[key][0] >= relation.date_update_found:
+                        log.debug(
+                            f"[?] Did not update relation {key[0]}->{key[1]}: update_date {relation.date_update_found} <= {existing[key][0]}")
+                        result.skipped += 1
+                        continue
+                    if existing[key][1] == relation.relation_type:
+                        result.skipped += 1
+                        continue
+                    result.updated += 1
+                else:
+                    result.inserted += 1
+                to_write.append(relation)
+                changed_primaries.add(relation.primary_anilist_id)
+
+            # The WHERE clause repeats the checks above, so a row written by
+            # another connection in the meantime is never overwritten by older data
+            cursor.executemany(
                 """
-                INSERT OR REPLACE INTO anime_relations (
+                INSERT INTO anime_relations (
                     primary_anilist_id, related_anilist_id, relation_type, date_update_found
                 ) VALUES (?, ?, ?, ?)
+                ON CONFLICT(primary_anilist_id, related_anilist_id) DO UPDATE SET
+                    relation_type=excluded.relation_type,
+                    date_update_found=excluded.date_update_found
+                WHERE excluded.date_update_found > COALESCE(anime_relations.date_update_found, 0)
+                    AND excluded.relation_type != anime_relations.relation_type
                 """,
-                (
-                    relation.primary_anilist_id,
-                    relation.related_anilist_id,
-                    relation.relation_type,
-                    relation.date_update_found
-                )
+                [
+                    (
+                        relation.primary_anilist_id,
+                        relation.related_anilist_id,
+                        relation.relation_type,
+                        relation.date_update_found
+                    )
+                    for relation in to_write
+                ]
             )
-            cursor.execute(
+            result.invalidated_ids = sorted(changed_primaries)
+            for chunk in chunk_list(result.invalidated_ids, SQL_CHUNK_SIZE):
+                cursor.execute(
+                    f"""DELETE FROM franchise_member WHERE anime_id IN ({",".join("?" * len(chunk))})""",
+                    chunk
+                )
+            # A changed relation set deserves a fresh attempt, even if it was backed off
+            cursor.executemany(
                 """
-                UPDATE anime SET related_to = '' WHERE id = ?
+                INSERT INTO relation_resolution_queue (anime_id) VALUES (?)
+                ON CONFLICT(anime_id) DO UPDATE SET attempts=0, next_retry_at=0, last_error=NULL
                 """,
-                (relation.primary_anilist_id,)
+                [(anime_id,) for anime_id in result.invalidated_ids]
             )
-        conn.commit()
-        log.info("[+] Bulk insert successful")
+        log.info(
+            f"[+] Bulk insert successful (inserted: {result.inserted}, updated: {result.updated}, skipped: {result.skipped}, invalidated: {len(result.invalidated_ids)})")
     except Exception as e:
         log.error(f"[!] Error during bulk insert: {e}")
-        return False
-    finally:
-        conn.close()
-    return True
+        return None
+    return result
 
 
 def add_user_anime_bulk(anime_ids: list[int], user_id: int) -> bool:
     log.info(
         f"[.] Adding bulk user_anime (user_id: {user_id}, len anime_ids: {len(anime_ids)})")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
     try:
-        cursor.executemany(
-            """
-            INSERT OR ignore INTO user_anime (
-                anilist_user_id, anime_id
-            ) VALUES (?, ?)
-            """,
-            [
-                (
-                    user_id,
-                    anime_id
-                )
-                for anime_id in anime_ids
-            ]
-        )
-        conn.commit()
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                """
+                INSERT OR ignore INTO user_anime (
+                    anilist_user_id, anime_id
+                ) VALUES (?, ?)
+                """,
+                [
+                    (
+                        user_id,
+                        anime_id
+                    )
+                    for anime_id in anime_ids
+                ]
+            )
         log.info("[+] Bulk insert into user_anime successful")
         return True
     except Exception as e:
         log.error(f"[!] Error during bulk insert into user_anime: {e}")
         return False
-    finally:
-        conn.close()
-    return True
 
 
 def delete_user_anime_bulk(anime_ids: list[int], user_id: int) -> bool:
     log.info(
         f"[.] Deleting bulk user_anime (user_id: {user_id}, len anime_ids: {len(anime_ids)})")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.executemany(
-        """
-        DELETE FROM user_anime WHERE anilist_user_id=? AND anime_id=?
-        """,
-        [
-            (user_id, anime_id)
-            for anime_id in anime_ids
-        ]
-    )
-    conn.commit()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            """
+            DELETE FROM user_anime WHERE anilist_user_id=? AND anime_id=?
+            """,
+            [
+                (user_id, anime_id)
+                for anime_id in anime_ids
+            ]
+        )
     log.info("[+] Bulk delete from user_anime successful")
     return True
 
 
-def get_last_user_activity(user_id: int) -> int:
-    log.info(f"[.] Getting last user activity (userid: {user_id})")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT last_activity_checked FROM users WHERE anilist_id = ?""",
-        (user_id,),
-    )
-    res = cursor.fetchall()
-    conn.close()
-    if len(res) != 1 or len(res[0]) != 1:
-        log.info("[+] Activity date not found, returning 0")
-        return 0
-    log.info(f"[+] Found activity date: {res[0][0]}")
-    return res[0][0]
-
-
-def check_anime_in_db(anime_id: int) -> bool:
-    log.info(f"[.] Checking if anime is already in db {anime_id}")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT id FROM anime WHERE id = ?""",
-        (anime_id,),
-    )
-    res = cursor.fetchall()
-    conn.close()
-    if len(res) != 1 or len(res[0]) != 1:
-        log.info("[-] Anime not in db")
-        return False
-    log.info("[+] Anime is in db")
-    return True
+def get_last_user_activities() -> dict[int, int]:
+    """last_activity_checked of every linked anilist user, 0 when the anilist account is linked more than once"""
+    log.info("[.] Getting last activity of every user")
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT anilist_id, CASE WHEN COUNT(*) = 1 THEN MAX(last_activity_checked) ELSE 0 END
+            FROM users WHERE anilist_id != -1 GROUP BY anilist_id
+            """
+        )
+        res = cursor.fetchall()
+    return {user_id: last_activity or 0 for user_id, last_activity in res}
+
+
+def store_user_activities(activities: dict[int, tuple[list[int], list[int], int]]):
+    """Apply the new activities (new anime, deleted anime, last activity date) of many users in one transaction"""
+    log.info(f"[.] Storing the new activities of {len(activities)} users")
+    with connection():
+        for user_id, (new_anime, deleted_anime, max_activity_date) in activities.items():
+            delete_user_anime_bulk(deleted_anime, user_id)
+            # add_user_anime_bulk logs and swallows its errors, raising keeps last_activity_checked with the anime
+            if not add_user_anime_bulk(new_anime, user_id):
+                raise Exception(f"Could not store the new anime of user {user_id}")
+            update_last_user_activity(user_id, max_activity_date)
+    log.info(f"[+] Stored the new activities of {len(activities)} users")
+
+
+def get_missing_anime_ids(anime_ids: list[int]) -> list[int]:
+    """The anime_ids that are not in the anime table, with one query per SQL_CHUNK_SIZE ids"""
+    found: set[int] = set()
+    with connection() as conn:
+        cursor = conn.cursor()
+        for chunk in chunk_list(list(dict.fromkeys(anime_ids)), SQL_CHUNK_SIZE):
+            cursor.execute(
+                f"SELECT id FROM anime WHERE id IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            found.update(r[0] for r in cursor.fetchall())
+    missing = [anime_id for anime_id in dict.fromkeys(anime_ids) if anime_id not in found]
+    log.info(f"[i] {len(missing)} of {len(anime_ids)} anime are not in the database")
+    return missing
 
 
 def get_user_id_list() -> list[int]:
     log.info("[.] Getting user id list")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT anilist_id FROM users""",
-    )
-    res = cursor.fetchall()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT anilist_id FROM users""",
+        )
+        res = cursor.fetchall()
     return [r[0] for r in res] or []
 
 
 def update_last_user_activity(user_id: int, last_activity: int):
     log.info(
         f"[.] Updating last user activity for user_id {user_id} and new activity {last_activity}")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """UPDATE users SET last_activity_checked=? WHERE anilist_id=?""",
-        (last_activity, user_id, ),
-    )
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """UPDATE users SET last_activity_checked=? WHERE anilist_id=?""",
+            (last_activity, user_id, ),
+        )
     return
 
 
-def get_last_updated_at() -> int:
-    log.info("[.] Getting user id list")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT updated_at FROM anime ORDER BY updated_at DESC LIMIT 1 """,
+def get_sync_state(name: str) -> SyncState:
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT watermark, crawl_watermark, current_page, page_tries, high_water_mark
+            FROM sync_state WHERE name = ?
+            """,
+            (name,)
+        )
+        res = cursor.fetchone()
+    if res is None:
+        return SyncState(name=name, watermark=0)
+    return SyncState(name, *res)
+
+
+def save_sync_state(state: SyncState):
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            INSERT INTO sync_state (
+                name, watermark, crawl_watermark, current_page, page_tries, high_water_mark, updated_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                watermark=excluded.watermark,
+                crawl_watermark=excluded.crawl_watermark,
+                current_page=excluded.current_page,
+                page_tries=excluded.page_tries,
+                high_water_mark=excluded.high_water_mark,
+                updated_at=excluded.updated_at
+            """,
+            (state.name, state.watermark, state.crawl_watermark, state.current_page,
+             state.page_tries, state.high_water_mark, int(time.time()))
+        )
+
+
+# Column order expected by anime_from_row, for queries that join anime
+ANIME_DATA_COLUMNS = "a.id, a.title, a.type, a.status, a.cover, a.episodes, a.latest_aired_episode, a.start_date, a.updated_at"
+
+
+def anime_from_row(row: tuple) -> AnimeData:
+    return AnimeData(
+        id=row[0],
+        title=row[1],
+        type=row[2],
+        status=row[3],
+        cover=row[4],
+        episodes=row[5],
+        latest_aired_episode=row[6],
+        start_date=row[7],
+        updated_date=row[8]
     )
-    res = cursor.fetchall()
-    conn.close()
-    if len(res) != 1 or len(res[0]) != 1:
-        return 0
-    return res[0][0]
 
 
 def get_anime_data(anime_id: int) -> AnimeData | None:
     log.debug(f"[.] Getting anime data for anime {anime_id}")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT title,type,status,cover,episodes,latest_aired_episode,start_date,updated_at FROM anime WHERE id=?""",
-        (anime_id,)
-    )
-    res = cursor.fetchall()
-    conn.close()
-    anime: AnimeData | None = None
-    if len(res) == 1 and len(res[0]) == 8:
-        anime = AnimeData(
-            id=anime_id,
-            title=res[0][0],
-            type=res[0][1],
-            status=res[0][2],
-            cover=res[0][3],
-            episodes=res[0][4],
-            latest_aired_episode=res[0][5],
-            start_date=res[0][6],
-            updated_date=res[0][7]
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""SELECT {ANIME_DATA_COLUMNS} FROM anime a WHERE a.id=?""",
+            (anime_id,)
         )
+        res = cursor.fetchone()
+    anime: AnimeData | None = None
+    if res is not None:
+        anime = anime_from_row(res)
     log.debug(f"[i] Done getting data for anime {anime_id}")
     return anime
 
 
 def get_anime_relations(anime_id: int) -> list[AnimeRelation] | None:
     log.debug(f"\t\t\t[.] Getting anime relations for anime {anime_id}")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT related_anilist_id, relation_type, date_update_found FROM anime_relations WHERE primary_anilist_id=?""",
-        (anime_id,)
-    )
-    res = cursor.fetchall()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT related_anilist_id, relation_type, date_update_found FROM anime_relations WHERE primary_anilist_id=?""",
+            (anime_id,)
+        )
+        res = cursor.fetchall()
     relation_list: list[AnimeRelation] = []
     for v in res:
         if len(v) != 3:
@@ -368,240 +423,664 @@ def get_anime_relations(anime_id: int) -> list[AnimeRelation] | None:
     return relation_list
 
 
-def update_anime_related_to(anime_id: int, relation_id: int):
-    log.debug(f"[.] Getting anime relations for anime {anime_id}")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT status, old_status, related_to FROM anime WHERE id = ?""",
-        (anime_id,),
-    )
-    res = cursor.fetchall()
-    if not res or len(res) == 0:
-        log.error(
-            f"[!] Can't update anime relation because anime does not exists {anime_id} {relation_id}")
-        return
-    if len(res[0]) != 3:
+def get_relation_edges() -> list[tuple[int, int, str]]:
+    log.debug("[.] Getting all anime relations")
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT primary_anilist_id, related_anilist_id, relation_type FROM anime_relations""")
+        res = cursor.fetchall()
+    return res
+
+
+def get_anime_start_dates() -> dict[int, int]:
+    log.debug("[.] Getting all anime start dates")
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""SELECT id, start_date FROM anime""")
+        res = cursor.fetchall()
+    return {r[0]: r[1] for r in res}
+
+
+def update_anime_related_to_bulk(franchise_id: int, anime_ids: list[int]):
+    """Make franchise_id the only franchise of anime_ids and queue the notifications about new and changed anime"""
+    log.debug(
+        f"[.] Updating franchise {franchise_id} ({len(anime_ids)} anime)")
+    statuses: list[tuple[int, str, str | None, int]] = []
+    with connection() as conn:
+        cursor = conn.cursor()
+        for chunk in chunk_list(anime_ids, SQL_CHUNK_SIZE):
+            placeholders = ",".join("?" * len(chunk))
+            cursor.execute(
+                f"""SELECT id, status, old_status, updated_at FROM anime WHERE id IN ({placeholders})""",
+                chunk
+            )
+            statuses += cursor.fetchall()
+            cursor.execute(
+                f"""DELETE FROM franchise_member WHERE anime_id IN ({placeholders}) AND franchise_id != ?""",
+                chunk + [franchise_id]
+            )
+        cursor.executemany(
+            """INSERT OR IGNORE INTO franchise_member (franchise_id, anime_id) VALUES (?, ?)""",
+            [(franchise_id, anime_id) for anime_id, _, _, _ in statuses]
+        )
+        cursor.executemany(
+            """DELETE FROM relation_resolution_queue WHERE anime_id = ?""",
+            [(anime_id,) for anime_id, _, _, _ in statuses]
+        )
+
+        # Queued in the same transaction: the notifications are sent by the
+        # outbox drainer, never while this write lock is held
+        events: dict[int, NotificationEvent] = {}
+        for anime_id, status, old_status, updated_at in statuses:
+            if old_status == NO_OLD_DATA_FOUND_STATUS or old_status is None:
+                events[anime_id] = NotificationEvent(f"new:{anime_id}", anime_id, "new")
+            elif status != old_status:
+                events[anime_id] = NotificationEvent(
+                    f"status_change:{anime_id}:{status}:{updated_at}", anime_id, "status_change")
+        recipients: dict[int, list[int]] = {anime_id: [] for anime_id in events}
+        for chunk in chunk_list(list(events), SQL_CHUNK_SIZE):
+            cursor.execute(
+                f"""
+                SELECT ua.anime_id, u.telegram_id FROM user_anime ua
+                JOIN users u ON ua.anilist_user_id = u.anilist_id
+                WHERE ua.anime_id IN ({",".join("?" * len(chunk))}) AND u.telegram_id != -1 AND u.inactive_at IS NULL
+                """,
+                chunk
+            )
+            for anime_id, telegram_id in cursor.fetchall():
+                recipients[anime_id].append(telegram_id)
+        enqueue_notifications([(events[anime_id], recipients[anime_id]) for anime_id in events])
+    if len(statuses) != len(anime_ids):
         log.error(
-            f"[!] Something went wrong while extracting anime information during relation {anime_id}->{relation_id} insertion")
+            f"[!] Can't update anime relation because {len(anime_ids) - len(statuses)} anime of franchise {franchise_id} do not exist")
+    log.debug(f"[i] Done updating franchise {franchise_id}")
+
+
+def render_events(cursor, events: list[NotificationEvent]) -> list[NotificationEvent]:
+    """Render the message of each event from the stored anime, dropping the events of missing anime"""
+    anime: dict[int, AnimeData] = {}
+    for chunk in chunk_list(list({e.anime_id for e in events}), SQL_CHUNK_SIZE):
+        cursor.execute(
+            f"SELECT {ANIME_DATA_COLUMNS} FROM anime a WHERE a.id IN ({','.join('?' * len(chunk))})",
+            chunk
+        )
+        anime.update({r[0]: anime_from_row(r) for r in cursor.fetchall()})
+    rendered = [render_notification_event(e, anime[e.anime_id]) for e in events if e.anime_id in anime]
+    if len(rendered) != len(events):
+        log.warning(
+            f"[!] Could not find the anime of {len(events) - len(rendered)} notification events")
+    return rendered
+
+
+def enqueue_notifications(events: list[tuple[NotificationEvent, list[int]]]):
+    """
+    Queue each event for its recipients (telegram ids). The message is
+    rendered once per event and every outbox entry references it
+    """
+    events = [(event, telegram_ids) for event, telegram_ids in events if len(telegram_ids) > 0]
+    if len(events) == 0:
         return
-    related_string = ''
-    if len(res[0]) == 3 and len(res[0][2]) > 0:
-        related_string = res[0][2] + '|'
-    if str(relation_id) not in related_string.split('|'):
+    log.debug(
+        f"[.] Queueing {len(events)} notification events for {sum(len(t) for _, t in events)} recipients")
+    now = int(time.time())
+    with connection() as conn:
+        cursor = conn.cursor()
+        rendered = render_events(cursor, [event for event, _ in events])
+        cursor.executemany(
+            """
+            INSERT OR IGNORE INTO notification_event (
+                event_key, anime_id, notification_type, caption, digest_line, photo, created_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            [(e.event_key, e.anime_id, e.notification_type, e.caption, e.digest_line, e.photo, now)
+             for e in rendered]
+        )
+        event_ids: dict[str, int] = {}
+        for chunk in chunk_list([e.event_key for e in rendered], SQL_CHUNK_SIZE):
+            cursor.execute(
+                f"SELECT event_key, id FROM notification_event WHERE event_key IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            event_ids.update(dict(cursor.fetchall()))
+        cursor.executemany(
+            """
+            INSERT OR IGNORE INTO notification_outbox (
+                idempotency_key, telegram_id, anime_id, notification_type, created_at, event_id
+            ) VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            [(f"{event.event_key}:{telegram_id}", telegram_id, event.anime_id, event.notification_type, now,
+              event_ids[event.event_key])
+             for event, telegram_ids in events if event.event_key in event_ids
+             for telegram_id in telegram_ids]
+        )
+        cursor.executemany(
+            """
+            UPDATE notification_event SET recipients = (
+                SELECT COUNT(*) FROM notification_outbox o WHERE o.event_id = notification_event.id
+            ) WHERE id = ?
+            """,
+            [(event_id,) for event_id in event_ids.values()]
+        )
+
+
+def get_pending_notifications(now: int, limit: int, digest_window: int) -> list[tuple[OutboxEntry, NotificationEvent | None, bool]]:
+    """
+    The next entries to send, each with its event and whether the chat is in
+    digest mode. Entries of a digest chat are held back until its oldest
+    pending entry is digest_window old
+    """
+    with connection() as conn:
+        cursor = conn.cursor()
         cursor.execute(
-            """UPDATE anime SET related_to = ? WHERE id=?""",
-            (related_string+str(relation_id), anime_id)
-        )
-    if res[0][1] == NO_OLD_DATA_FOUND_STATUS or res[0][1] is None:
-        user_ids = get_user_ids_for_anime(anime_id)
-        if user_ids:
-            anime = get_anime_data(anime_id)
-            if not anime:
-                log.warning(
-                    f"[!] Could not find anime with id {anime_id} for notification")
-            for u in user_ids:
-                send_telegram_notification(u, anime, "new")  # type: ignore
-    elif res[0][0] != res[0][1]:
-        user_ids = get_user_ids_for_anime(anime_id)
-        if user_ids:
-            anime = get_anime_data(anime_id)
-            if not anime:
-                log.warning(
-                    f"[!] Could not find anime with id {anime_id} for notification")
-            for u in user_ids:
-                send_telegram_notification(
-                    u, anime, "status_change")  # type: ignore
-
-    conn.commit()
-    conn.close()
-    log.debug(f"[i] Done getting relations for anime {anime_id}")
-    return
+            """
+            WITH pending AS (
+                SELECT o.*, EXISTS (
+                    SELECT 1 FROM users u WHERE u.telegram_id = o.telegram_id AND u.notification_mode = 'digest'
+                ) AS digest
+                FROM notification_outbox o
+                WHERE o.delivered_at IS NULL AND o.failed_at IS NULL AND o.next_attempt_at <= ?
+            )
+            SELECT o.idempotency_key, o.telegram_id, o.anime_id, o.notification_type, o.id, o.attempts, o.event_id,
+                o.digest, e.event_key, e.caption, e.digest_line, e.photo
+            FROM pending o
+            LEFT JOIN notification_event e ON e.id = o.event_id
+            WHERE o.digest = 0 OR (
+                SELECT MIN(p.created_at) FROM pending p WHERE p.telegram_id = o.telegram_id
+            ) <= ?
+            ORDER BY o.id
+            LIMIT ?
+            """,
+            (now, now - digest_window, limit)
+        )
+        res = cursor.fetchall()
+        entries = [OutboxEntry(*r[:7]) for r in res]
+        events: dict[str, NotificationEvent] = {}
+        for entry, r in zip(entries, res):
+            if r[8] is not None:
+                events[entry.idempotency_key] = NotificationEvent(
+                    r[8], entry.anime_id, entry.notification_type, r[9], r[10], r[11], entry.event_id or 0)
+        # Entries queued before events existed are rendered now
+        legacy = [
+            NotificationEvent(entry.idempotency_key, entry.anime_id, entry.notification_type)
+            for entry in entries if entry.event_id is None
+        ]
+        events.update({e.event_key: e for e in render_events(cursor, legacy)})
+    return [(entry, events.get(entry.idempotency_key), bool(r[7])) for entry, r in zip(entries, res)]
 
 
-def find_next_unrelated_anime(offset: int) -> int | None:
-    log.debug("[.] Getting unrelated anime")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT id FROM anime WHERE related_to='' limit 1 offset ?""",
-        (offset,)
+def update_event_stats(cursor, event_ids: set[int], started_at: float) -> list[EventStats]:
+    """Recount the outcome of the events, returns the stats of the ones that have no pending recipient left"""
+    cursor.executemany(
+        """
+        UPDATE notification_event SET
+            delivered = (SELECT COUNT(*) FROM notification_outbox o WHERE o.event_id = notification_event.id AND o.delivered_at IS NOT NULL),
+            failed = (SELECT COUNT(*) FROM notification_outbox o WHERE o.event_id = notification_event.id AND o.failed_at IS NOT NULL),
+            started_at = COALESCE(started_at, ?)
+        WHERE id = ?
+        """,
+        [(started_at, event_id) for event_id in event_ids]
     )
-    res = cursor.fetchall()
-    conn.close()
-    if len(res) != 1:
-        log.debug("[i] No unrelated anime found")
-        return None
-    if len(res[0]) != 1:
-        log.error(
-            "[!] Could not find unrelated anime, error in the database result")
-        return None
-    log.debug(f"[i] Done getting unrelated anime (id: {res[0][0]})")
-    return res[0][0]
+    cursor.executemany(
+        """UPDATE notification_event SET finished_at = ? WHERE id = ? AND finished_at IS NULL AND delivered + failed >= recipients""",
+        [(time.time(), event_id) for event_id in event_ids]
+    )
+    finished: list[EventStats] = []
+    for chunk in chunk_list(list(event_ids), SQL_CHUNK_SIZE):
+        cursor.execute(
+            f"""
+            SELECT event_key, recipients, delivered, failed, finished_at - started_at FROM notification_event
+            WHERE id IN ({",".join("?" * len(chunk))}) AND finished_at IS NOT NULL
+            AND delivered + failed >= recipients
+            """,
+            chunk
+        )
+        finished += [EventStats(*r) for r in cursor.fetchall()]
+    return finished
+
+
+def record_notification_results(delivered_ids: list[int], retry: list[tuple[int, str]], failed: list[tuple[int, str]], now: int, base_delay: int, max_delay: int, max_attempts: int, started_at: float) -> list[EventStats]:
+    """
+    Store the outcome of a sent batch in one transaction. Retried entries
+    back off exponentially and are given up after max_attempts.
+    Returns the stats of the events that have no pending recipient left
+    """
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            """UPDATE notification_outbox SET delivered_at = ?, attempts = attempts + 1, last_error = NULL WHERE id = ?""",
+            [(now, outbox_id) for outbox_id in delivered_ids]
+        )
+        cursor.executemany(
+            """
+            UPDATE notification_outbox SET
+                attempts = attempts + 1,
+                next_attempt_at = ? + MIN(?, ? * (1 << MIN(attempts, 30))),
+                last_error = ?,
+                failed_at = CASE WHEN attempts + 1 >= ? THEN ? ELSE NULL END
+            WHERE id = ?
+            """,
+            [(now, max_delay, base_delay, error, max_attempts, now, outbox_id)
+             for outbox_id, error in retry]
+        )
+        cursor.executemany(
+            """UPDATE notification_outbox SET attempts = attempts + 1, last_error = ?, failed_at = ? WHERE id = ?""",
+            [(error, now, outbox_id) for outbox_id, error in failed]
+        )
+        outbox_ids = delivered_ids + [outbox_id for outbox_id, _ in retry + failed]
+        event_ids: set[int] = set()
+        for chunk in chunk_list(outbox_ids, SQL_CHUNK_SIZE):
+            cursor.execute(
+                f"""
+                SELECT DISTINCT event_id FROM notification_outbox
+                WHERE id IN ({",".join("?" * len(chunk))}) AND event_id IS NOT NULL
+                """,
+                chunk
+            )
+            event_ids.update(r[0] for r in cursor.fetchall())
+        return update_event_stats(cursor, event_ids, started_at)
+
+
+def deactivate_telegram_users(unreachable: list[tuple[int, str]], now: int):
+    """Stop notifying the (telegram_id, error) chats that can't be reached, their pending notifications are given up"""
+    if len(unreachable) == 0:
+        return
+    log.info(f"[.] Marking {len(unreachable)} unreachable telegram users as inactive")
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "UPDATE users SET inactive_at = ? WHERE telegram_id = ? AND inactive_at IS NULL",
+            [(now, telegram_id) for telegram_id, _ in unreachable]
+        )
+        event_ids: set[int] = set()
+        for chunk in chunk_list([telegram_id for telegram_id, _ in unreachable], SQL_CHUNK_SIZE):
+            cursor.execute(
+                f"""
+                SELECT DISTINCT event_id FROM notification_outbox
+                WHERE telegram_id IN ({",".join("?" * len(chunk))}) AND event_id IS NOT NULL
+                AND delivered_at IS NULL AND failed_at IS NULL
+                """,
+                chunk
+            )
+            event_ids.update(r[0] for r in cursor.fetchall())
+        cursor.executemany(
+            """
+            UPDATE notification_outbox SET failed_at = ?, last_error = ?
+            WHERE telegram_id = ? AND delivered_at IS NULL AND failed_at IS NULL
+            """,
+            [(now, error, telegram_id) for telegram_id, error in unreachable]
+        )
+        update_event_stats(cursor, event_ids, now)
+
+
+def get_cover_file_ids(anime_ids: list[int]) -> dict[str, str]:
+    """Telegram file_id of the current cover of the anime, by cover url"""
+    file_ids: dict[str, str] = {}
+    with connection() as conn:
+        cursor = conn.cursor()
+        for chunk in chunk_list(list(set(anime_ids)), SQL_CHUNK_SIZE):
+            cursor.execute(
+                f"""
+                SELECT c.cover_url, c.file_id FROM telegram_file_cache c
+                JOIN anime a ON a.id = c.anime_id AND a.cover = c.cover_url
+                WHERE c.anime_id IN ({",".join("?" * len(chunk))})
+                """,
+                chunk
+            )
+            file_ids.update(dict(cursor.fetchall()))
+    return file_ids
+
+
+def save_cover_file_ids(file_ids: list[tuple[int, str, str]], now: int):
+    """Cache the (anime_id, cover_url, file_id) uploads, replacing the ones of older covers"""
+    if len(file_ids) == 0:
+        return
+    log.debug(f"[.] Caching {len(file_ids)} Telegram cover file ids")
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            """
+            INSERT INTO telegram_file_cache (anime_id, cover_url, file_id, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(anime_id) DO UPDATE SET
+                cover_url=excluded.cover_url,
+                file_id=excluded.file_id,
+                updated_at=excluded.updated_at
+            """,
+            [(anime_id, cover_url, file_id, now) for anime_id, cover_url, file_id in file_ids]
+        )
+
+
+def get_pending_relation_resolutions(now: int, after_id: int, limit: int) -> list[int]:
+    log.debug("[.] Getting anime waiting for relation resolution")
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT anime_id FROM relation_resolution_queue
+            WHERE next_retry_at <= ? AND anime_id > ?
+            ORDER BY anime_id
+            LIMIT ?
+            """,
+            (now, after_id, limit)
+        )
+        res = cursor.fetchall()
+    log.debug(f"[i] Found {len(res)} anime waiting for relation resolution")
+    return [r[0] for r in res]
+
+
+def postpone_relation_resolutions(anime_ids: list[int], now: int, base_delay: int, max_delay: int, error: str):
+    """Exponential backoff: the n-th failed attempt waits base_delay * 2^(n-1) seconds, capped at max_delay"""
+    log.info(
+        f"[.] Postponing relation resolution of {len(anime_ids)} anime")
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            """
+            UPDATE relation_resolution_queue SET
+                attempts = attempts + 1,
+                next_retry_at = ? + MIN(?, ? * (1 << MIN(attempts, 30))),
+                last_error = ?
+            WHERE anime_id = ?
+            """,
+            [(now, max_delay, base_delay, error, anime_id)
+             for anime_id in anime_ids]
+        )
+
+
+def get_due_airing_anime(now: int) -> list[int]:
+    """Watched airing anime whose scheduled episode should be out by now"""
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT s.anime_id FROM airing_schedule s
+            JOIN anime a ON a.id = s.anime_id
+            WHERE s.next_check_at <= ?
+              AND a.status IN ('RELEASING', 'NOT_YET_RELEASED')
+              AND EXISTS (SELECT 1 FROM user_anime ua WHERE ua.anime_id = s.anime_id)
+            ORDER BY s.next_check_at
+            """,
+            (now,)
+        )
+        res = cursor.fetchall()
+    return [r[0] for r in res]
+
+
+def get_watched_refresh_ids() -> list[int]:
+    """
+    Anime the targeted refresh keeps up to date: watched anime that are not
+    stored yet, plus the airing or upcoming anime of every watched franchise
+    """
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT ua.anime_id FROM user_anime ua
+            WHERE NOT EXISTS (SELECT 1 FROM anime a WHERE a.id = ua.anime_id)
+            UNION
+            SELECT a.id FROM anime a
+            WHERE a.status IN ('RELEASING', 'NOT_YET_RELEASED')
+              AND (
+                EXISTS (SELECT 1 FROM user_anime ua WHERE ua.anime_id = a.id)
+                OR EXISTS (
+                    SELECT 1 FROM franchise_member fm
+                    JOIN franchise_member watched ON watched.franchise_id = fm.franchise_id
+                    JOIN user_anime ua ON ua.anime_id = watched.anime_id
+                    WHERE fm.anime_id = a.id
+                )
+              )
+            """
+        )
+        res = cursor.fetchall()
+    return [r[0] for r in res]
+
+
+def postpone_airing_checks(anime_ids: list[int], now: int, next_check_at: int):
+    """Check again later the anime whose schedule was not moved forward by the refresh"""
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            """UPDATE airing_schedule SET next_check_at = ? WHERE anime_id = ? AND next_check_at <= ?""",
+            [(next_check_at, anime_id, now) for anime_id in anime_ids]
+        )
+
+
+def get_queued_anime_fetches() -> list[int]:
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT anime_id FROM anime_fetch_queue ORDER BY queued_at, anime_id""")
+        res = cursor.fetchall()
+    return [r[0] for r in res]
+
+
+def queue_anime_fetches(anime_ids: list[int]):
+    log.debug(f"[.] Queueing {len(anime_ids)} anime to fetch")
+    now = int(time.time())
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            """INSERT OR IGNORE INTO anime_fetch_queue (anime_id, queued_at) VALUES (?, ?)""",
+            [(anime_id, now) for anime_id in anime_ids]
+        )
+
+
+def remove_anime_fetches(anime_ids: list[int]):
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            """DELETE FROM anime_fetch_queue WHERE anime_id = ?""",
+            [(anime_id,) for anime_id in anime_ids]
+        )
 
 
 def get_telegram_id_list() -> list[int]:
     log.info("[.] Getting telegram id list")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT telegram_id FROM users WHERE telegram_id != -1""",
-    )
-    res = cursor.fetchall()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT telegram_id FROM users WHERE telegram_id != -1""",
+        )
+        res = cursor.fetchall()
     return [r[0] for r in res] or []
 
 
 def update_anilist_username(telegram_id: int, anilist_username: str):
     log.info(
         f"[.] Upsert user: telegram_id={telegram_id}, anilist_username={anilist_username}")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT anilist_id FROM users WHERE telegram_id=?
-        """,
-        (telegram_id,)
-    )
-    res = cursor.fetchall()
-    if not res:
-        raise Exception(
-            "Something went wrong, user missing but it should not be missing")
-    if len(res) == 1:
+    with connection() as conn:
+        cursor = conn.cursor()
         cursor.execute(
             """
-            DELETE FROM user_anime WHERE anilist_user_id=?
+            SELECT anilist_id FROM users WHERE telegram_id=?
             """,
-            (res[0][0],)
+            (telegram_id,)
+        )
+        res = cursor.fetchall()
+        if not res:
+            raise Exception(
+                "Something went wrong, user missing but it should not be missing")
+        if len(res) == 1:
+            cursor.execute(
+                """
+                DELETE FROM user_anime WHERE anilist_user_id=?
+                """,
+                (res[0][0],)
+            )
+        cursor.execute(
+            """
+            UPDATE users SET anilist_username=?,anilist_id=-1 WHERE telegram_id=?
+            """,
+            (anilist_username, telegram_id)
         )
-    cursor.execute(
-        """
-        UPDATE users SET anilist_username=?,anilist_id=-1 WHERE telegram_id=?
-        """,
-        (anilist_username, telegram_id)
-    )
-    conn.commit()
-    conn.close()
     log.info("[+] update anilist username done")
 
 
 def get_user_info_by_telegram_id(telegram_id: int):
     log.info(f"[.] Getting user info for telegram_id={telegram_id}")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT anilist_username, anilist_id, last_activity_checked
-        FROM users WHERE telegram_id = ?
-        """,
-        (telegram_id,)
-    )
-    res = cursor.fetchone()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT anilist_username, anilist_id, last_activity_checked, notification_mode
+            FROM users WHERE telegram_id = ?
+            """,
+            (telegram_id,)
+        )
+        res = cursor.fetchone()
     if res:
         return {
             "anilist_username": res[0],
             "anilist_id": res[1],
-            "last_activity_checked": res[2]
+            "last_activity_checked": res[2],
+            "notification_mode": res[3] or "instant"
         }
     return None
 
 
+def set_notification_mode(telegram_id: int, notification_mode: str):
+    log.info(
+        f"[.] Setting notification mode of telegram_id={telegram_id} to {notification_mode}")
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE users SET notification_mode = ? WHERE telegram_id = ?",
+            (notification_mode, telegram_id)
+        )
+
+
 def check_and_update_telegram_user(telegram_id: int, telegram_handle: str | None) -> bool:
     log.info(
         f"[.] Checking/updating user: telegram_id={telegram_id}, telegram_handle={telegram_handle}")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM users WHERE telegram_id = ? AND telegram_handle=?",
-                   (telegram_id, telegram_handle))
-    res = cursor.fetchone()
-    if res and len(res) == 1:
-        return True
-    cursor.execute(
-        "SELECT id, telegram_handle FROM users WHERE telegram_id = ?", (telegram_id,))
-    user_by_id = cursor.fetchone()
-    cursor.execute(
-        "SELECT id, telegram_id FROM users WHERE telegram_handle = ?", (telegram_handle,))
-    user_by_handle = cursor.fetchone()
-    if user_by_id and user_by_handle:
+    with connection() as conn:
+        cursor = conn.cursor()
+        # Talking to the bot means the chat can be reached again
         cursor.execute(
-            "UPDATE users SET telegram_id=-1 WHERE telegram_id=?", (telegram_id,))
-        cursor.execute("UPDATE users SET telegram_id=? WHERE telegram_handle=?",
+            "UPDATE users SET inactive_at = NULL WHERE telegram_id = ? AND inactive_at IS NOT NULL", (telegram_id,))
+        if cursor.rowcount > 0:
+            log.info(f"[+] Telegram user {telegram_id} is active again")
+        cursor.execute("SELECT id FROM users WHERE telegram_id = ? AND telegram_handle=?",
                        (telegram_id, telegram_handle))
-        conn.commit()
-        conn.close()
-        return True
-    elif user_by_id:
-        cursor.execute("UPDATE users SET telegram_handle=? WHERE telegram_id=?",
-                       (telegram_handle, telegram_id))
-        conn.commit()
-        conn.close()
-        return True
-    elif user_by_handle:
-        cursor.execute("UPDATE users SET telegram_id=? WHERE telegram_handle=?",
-                       (telegram_id, telegram_handle))
-    conn.commit()
-    conn.close()
+        res = cursor.fetchone()
+        if res and len(res) == 1:
+            return True
+        cursor.execute(
+            "SELECT id, telegram_handle FROM users WHERE telegram_id = ?", (telegram_id,))
+        user_by_id = cursor.fetchone()
+        cursor.execute(
+            "SELECT id, telegram_id FROM users WHERE telegram_handle = ?", (telegram_handle,))
+        user_by_handle = cursor.fetchone()
+        if user_by_id and user_by_handle:
+            cursor.execute(
+                "UPDATE users SET telegram_id=-1 WHERE telegram_id=?", (telegram_id,))
+            cursor.execute("UPDATE users SET telegram_id=? WHERE telegram_handle=?",
+                           (telegram_id, telegram_handle))
+            return True
+        elif user_by_id:
+            cursor.execute("UPDATE users SET telegram_handle=? WHERE telegram_id=?",
+                           (telegram_handle, telegram_id))
+            return True
+        elif user_by_handle:
+            cursor.execute("UPDATE users SET telegram_id=? WHERE telegram_handle=?",
+                           (telegram_id, telegram_handle))
     return True
 
 
 def get_users_missing_ani_id():
     log.info("[.] Getting users with missing anilist_id")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT telegram_id, anilist_username FROM users WHERE anilist_id = -1 AND anilist_username IS NOT NULL AND anilist_username != ''
-        """
-    )
-    res = cursor.fetchall()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT telegram_id, anilist_username FROM users WHERE anilist_id = -1 AND anilist_username IS NOT NULL AND anilist_username != ''
+            """
+        )
+        res = cursor.fetchall()
     return res
 
 
 def update_user_anilist_id(telegram_id: int, anilist_id: int):
     log.info(
         f"[.] Updating anilist_id for telegram_id={telegram_id} to {anilist_id}")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        UPDATE users SET anilist_id=? WHERE telegram_id=?
-        """,
-        (anilist_id, telegram_id)
-    )
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            UPDATE users SET anilist_id=? WHERE telegram_id=?
+            """,
+            (anilist_id, telegram_id)
+        )
 
 
-def get_user_ids_for_anime(anime_id: int) -> list[int] | None:
-    log.info(f"[.] Getting user ids for anime_id={anime_id}")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT telegram_id FROM user_anime join users on user_anime.anilist_user_id = users.anilist_id WHERE user_anime.anime_id = ?
-        """,
-        (anime_id,)
-    )
-    res = cursor.fetchall()
-    conn.close()
+def get_onboarding_state(telegram_id: int, anilist_username: str) -> OnboardingState:
+    """The saved onboarding progress of the user, a fresh one if the username changed since"""
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT step, anilist_id, anime_ids FROM onboarding_state WHERE telegram_id = ? AND anilist_username = ?",
+            (telegram_id, anilist_username)
+        )
+        res = cursor.fetchone()
     if res is None:
-        return None
-    return [r[0] for r in res]
+        return OnboardingState(telegram_id, anilist_username)
+    return OnboardingState(telegram_id, anilist_username, res[0], res[1], json.loads(res[2]))
+
+
+def save_onboarding_state(state: OnboardingState):
+    log.debug(
+        f"[.] Saving onboarding of telegram_id={state.telegram_id} at step {state.step}")
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            INSERT INTO onboarding_state (telegram_id, anilist_username, step, anilist_id, anime_ids, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(telegram_id) DO UPDATE SET
+                anilist_username=excluded.anilist_username,
+                step=excluded.step,
+                anilist_id=excluded.anilist_id,
+                anime_ids=excluded.anime_ids,
+                updated_at=excluded.updated_at
+            """,
+            (state.telegram_id, state.anilist_username, state.step, state.anilist_id,
+             json.dumps(state.anime_ids), int(time.time()))
+        )
+
+
+def finish_onboarding(state: OnboardingState) -> bool:
+    """
+    Link the user to its anilist account and watched anime, dropping the
+    onboarding progress. Nothing is linked if the user changed username since
+    """
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT anilist_username FROM users WHERE telegram_id = ? AND anilist_id = -1", (state.telegram_id,))
+        res = cursor.fetchone()
+        if res is None or res[0] != state.anilist_username:
+            log.warning(
+                f"[!] Onboarding of telegram_id={state.telegram_id} ({state.anilist_username}) is outdated, dropping it")
+            cursor.execute(
+                "DELETE FROM onboarding_state WHERE telegram_id = ? AND anilist_username = ?",
+                (state.telegram_id, state.anilist_username))
+            return False
+        update_user_anilist_id(state.telegram_id, state.anilist_id)
+        # add_user_anime_bulk logs and swallows its errors, raising leaves the user unlinked with its onboarding kept
+        if not add_user_anime_bulk(state.anime_ids, state.anilist_id):
+            raise Exception(f"Could not store the watched anime of telegram_id={state.telegram_id}")
+        cursor.execute("DELETE FROM onboarding_state WHERE telegram_id = ?", (state.telegram_id,))
+    return True
 
 
 def add_user(telegram_id: int, telegram_handle: str):
     log.info(
         f"[.] Adding user: telegram_id={telegram_id}, telegram_handle={telegram_handle}")
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        INSERT INTO users (telegram_id, telegram_handle, anilist_username, anilist_id)
-        VALUES (?, ?, ?, ?)
-        """,
-        (telegram_id, telegram_handle, "", -1)
-    )
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            INSERT INTO users (telegram_id, telegram_handle, anilist_username, anilist_id)
+            VALUES (?, ?, ?, ?)
+            """,
+            (telegram_id, telegram_handle, "", -1)
+        )
@@ -0,0 +1,319 @@
+import sqlite3
+import time
+from typing import Callable
+
+from custom_logging import set_logger
+from db_connection import connection
+
+log = set_logger("DB_MIGRATIONS")
+
+
+def ensure_column(cursor: sqlite3.Cursor, table_name: str, column_name: str, column_type: str):
+    cursor.execute(f"PRAGMA table_info({table_name});")
+    columns = [row[1] for row in cursor.fetchall()]
+    if column_name in columns:
+        log.info(
+            f"\t\t[-] Column {column_name} on table {table_name} was already present")
+        return
+    cursor.execute(
+        f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type};")
+    log.info(
+        f"\t\t[+] Column {column_name} on table {table_name} added successfully")
+
+
+def migration_base_schema(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_handle TEXT,
+            anilist_id INTEGER,
+            last_activity_checked INTEGER DEFAULT 0
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS anime (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            type TEXT,
+            status TEXT,
+            cover TEXT,
+            episodes INTEGER,
+            latest_aired_episode INTEGER,
+            related_to TEXT DEFAULT ''
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_anime (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            anilist_user_id INTEGER,
+            anime_id INTEGER,
+            notified_episode INTEGER DEFAULT 0,
+            UNIQUE(anilist_user_id, anime_id)
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS anime_relations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            primary_anilist_id INTEGER,
+            related_anilist_id INTEGER,
+            relation_type TEXT,
+            UNIQUE(primary_anilist_id, related_anilist_id)
+        );
+    """)
+    # Databases created before the migration runner may miss any of these
+    ensure_column(cursor, "anime", "updated_at", "INTEGER DEFAULT 0")
+    ensure_column(cursor, "anime_relations", "date_update_found", "INTEGER DEFAULT 0")
+    ensure_column(cursor, "users", "telegram_id", "INTEGER DEFAULT -1")
+    ensure_column(cursor, "anime", "start_date", "INTEGER DEFAULT 0")
+    ensure_column(cursor, "anime", "old_status", "TEXT")
+    ensure_column(cursor, "users", "anilist_username", "TEXT")
+
+
+def migration_franchise_member(cursor: sqlite3.Cursor):
+    """Move the legacy '|'-joined anime.related_to values into franchise_member"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS franchise_member (
+            franchise_id INTEGER NOT NULL,
+            anime_id INTEGER NOT NULL,
+            PRIMARY KEY(franchise_id, anime_id)
+        );
+    """)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_franchise_member_anime_id ON franchise_member(anime_id);")
+    cursor.execute(
+        """SELECT id, related_to FROM anime WHERE related_to IS NOT NULL AND related_to != ''""")
+    members: list[tuple[int, int]] = []
+    for anime_id, related_to in cursor.fetchall():
+        for franchise_id in related_to.split('|'):
+            if franchise_id.isdigit():
+                members.append((int(franchise_id), anime_id))
+    cursor.executemany(
+        """INSERT OR IGNORE INTO franchise_member (franchise_id, anime_id) VALUES (?, ?)""",
+        members
+    )
+    cursor.execute(
+        """UPDATE anime SET related_to = '' WHERE related_to IS NOT NULL AND related_to != ''""")
+    log.info(f"\t\t[+] Migrated {len(members)} franchise memberships")
+
+
+def migration_secondary_indexes(cursor: sqlite3.Cursor):
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_user_anime_anime_id ON user_anime(anime_id);")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_anilist_id ON users(anilist_id);")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id);")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_anilist_username ON users(anilist_username);")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_telegram_handle ON users(telegram_handle);")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_anime_updated_at ON anime(updated_at);")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_anime_relations_related_id ON anime_relations(related_anilist_id);")
+    # Partial indexes: only the rows the hot queries filter on with a literal
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_missing_anilist_id ON users(telegram_id)
+        WHERE anilist_id = -1;
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_anime_airing ON anime(id)
+        WHERE status IN ('RELEASING', 'NOT_YET_RELEASED');
+    """)
+
+
+def migration_relation_resolution_queue(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS relation_resolution_queue (
+            anime_id INTEGER PRIMARY KEY,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_retry_at INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT
+        );
+    """)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_relation_resolution_queue_next_retry_at ON relation_resolution_queue(next_retry_at);")
+    cursor.execute("""
+        INSERT OR IGNORE INTO relation_resolution_queue (anime_id)
+        SELECT id FROM anime a
+        WHERE NOT EXISTS (SELECT 1 FROM franchise_member fm WHERE fm.anime_id = a.id)
+    """)
+    log.info(f"\t\t[+] Queued {cursor.rowcount} anime for relation resolution")
+
+
+def migration_anime_fetch_queue(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS anime_fetch_queue (
+            anime_id INTEGER PRIMARY KEY,
+            queued_at INTEGER NOT NULL DEFAULT 0
+        );
+    """)
+
+
+def migration_airing_schedule(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS airing_schedule (
+            anime_id INTEGER PRIMARY KEY,
+            episode INTEGER NOT NULL,
+            airing_at INTEGER NOT NULL,
+            next_check_at INTEGER NOT NULL
+        );
+    """)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_airing_schedule_next_check_at ON airing_schedule(next_check_at);")
+
+
+def migration_sync_state(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+            name TEXT PRIMARY KEY,
+            watermark INTEGER NOT NULL DEFAULT 0,
+            crawl_watermark INTEGER,
+            current_page INTEGER NOT NULL DEFAULT 1,
+            page_tries INTEGER NOT NULL DEFAULT 1,
+            high_water_mark INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER NOT NULL DEFAULT 0
+        );
+    """)
+    # The update feed used to stop at the newest stored anime
+    cursor.execute("""
+        INSERT OR IGNORE INTO sync_state (name, watermark, high_water_mark, updated_at)
+        SELECT 'update_feed', COALESCE(MAX(updated_at), 0), COALESCE(MAX(updated_at), 0), ? FROM anime
+    """, (int(time.time()),))
+
+
+def migration_notification_outbox(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            telegram_id INTEGER NOT NULL,
+            anime_id INTEGER NOT NULL,
+            notification_type TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            delivered_at INTEGER,
+            failed_at INTEGER
+        );
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_notification_outbox_pending ON notification_outbox(next_attempt_at)
+        WHERE delivered_at IS NULL AND failed_at IS NULL;
+    """)
+
+
+def migration_notification_mode(cursor: sqlite3.Cursor):
+    ensure_column(cursor, "users", "notification_mode", "TEXT DEFAULT 'instant'")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_notification_outbox_telegram_id ON notification_outbox(telegram_id);")
+
+
+def migration_telegram_file_cache(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS telegram_file_cache (
+            anime_id INTEGER PRIMARY KEY,
+            cover_url TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        );
+    """)
+
+
+def migration_notification_event(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS notification_event (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_key TEXT NOT NULL UNIQUE,
+            anime_id INTEGER NOT NULL,
+            notification_type TEXT NOT NULL,
+            caption TEXT NOT NULL,
+            digest_line TEXT NOT NULL,
+            photo TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            recipients INTEGER NOT NULL DEFAULT 0,
+            delivered INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            started_at REAL,
+            finished_at REAL
+        );
+    """)
+    ensure_column(cursor, "notification_outbox", "event_id", "INTEGER")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_notification_outbox_event_id ON notification_outbox(event_id);")
+
+
+def migration_user_inactive_at(cursor: sqlite3.Cursor):
+    # Set when telegram refuses every message to the chat, cleared when the user talks to the bot again
+    ensure_column(cursor, "users", "inactive_at", "INTEGER")
+
+
+def migration_onboarding_state(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS onboarding_state (
+            telegram_id INTEGER PRIMARY KEY,
+            anilist_username TEXT NOT NULL,
+            step TEXT NOT NULL,
+            anilist_id INTEGER NOT NULL DEFAULT -1,
+            anime_ids TEXT NOT NULL DEFAULT '[]',
+            updated_at INTEGER NOT NULL
+        );
+    """)
+
+
+# Append only: a migration is identified by its position and applied once
+MIGRATIONS: list[tuple[str, Callable[[sqlite3.Cursor], None]]] = [
+    ("base_schema", migration_base_schema),
+    ("franchise_member", migration_franchise_member),
+    ("secondary_indexes", migration_secondary_indexes),
+    ("relation_resolution_queue", migration_relation_resolution_queue),
+    ("anime_fetch_queue", migration_anime_fetch_queue),
+    ("airing_schedule", migration_airing_schedule),
+    ("sync_state", migration_sync_state),
+    ("notification_outbox", migration_notification_outbox),
+    ("notification_mode", migration_notification_mode),
+    ("telegram_file_cache", migration_telegram_file_cache),
+    ("notification_event", migration_notification_event),
+    ("user_inactive_at", migration_user_inactive_at),
+    ("onboarding_state", migration_onboarding_state),
+]
+
+
+def get_schema_version(cursor: sqlite3.Cursor) -> int:
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at INTEGER
+        );
+    """)
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    res = cursor.fetchone()
+    return res[0] or 0
+
+
+def run_migrations():
+    """Apply every pending migration in a single transaction, then refresh the planner statistics"""
+    with connection() as conn:
+        cursor = conn.cursor()
+        current_version = get_schema_version(cursor)
+        if current_version >= len(MIGRATIONS):
+            log.info(f"\t[-] Schema is up to date (version {current_version})")
+            return
+        log.info(
+            f"\t[.] Migrating schema from version {current_version} to {len(MIGRATIONS)}")
+        if not conn.in_transaction:
+            cursor.execute("BEGIN IMMEDIATE")
+        for version, (name, migration) in enumerate(MIGRATIONS, start=1):
+            if version <= current_version:
+                continue
+            log.info(f"\t\t[.] Applying migration {version}: {name}")
+            migration(cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                (version, name, int(time.time()))
+            )
+    with connection() as conn:
+        conn.execute("ANALYZE")
+    log.info(f"\t[-] Done running migrations (version {len(MIGRATIONS)})")
@@ -0,0 +1,62 @@
+from anilist_api_interactor import MAX_ANIME_PER_QUERY, get_anime_data_from_id
+from custom_dataclasses import AnimeData, AnimeRelation
+from custom_logging import set_logger
+from db_interactor import add_anime_bulk, add_relations_bulk, get_queued_anime_fetches, queue_anime_fetches, remove_anime_fetches
+
+log = set_logger("FETCH_QUEUE")
+
+
+class FetchQueue:
+    """
+    Anime ids that have to be fetched from anilist.
+
+    Ids are deduplicated in memory and persisted in anime_fetch_queue, so ids
+    collected before a restart are fetched by the next cycle. Fetching is done
+    in full MAX_ANIME_PER_QUERY batches, one request each.
+    """
+
+    def __init__(self):
+        self.pending: dict[int, None] = dict.fromkeys(get_queued_anime_fetches())
+        # Ids anilist did not return during this cycle, they are not requested again
+        self.not_found: set[int] = set()
+        if len(self.pending) > 0:
+            log.info(
+                f"[i] Restored {len(self.pending)} anime ids to fetch from the previous run")
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def add(self, anime_ids: list[int]):
+        new_ids = [i for i in anime_ids if i not in self.pending and i not in self.not_found]
+        if len(new_ids) == 0:
+            return
+        self.pending.update(dict.fromkeys(new_ids))
+        queue_anime_fetches(new_ids)
+
+    def flush(self, full_batches_only: bool = False) -> tuple[list[AnimeData], list[AnimeRelation]]:
+        """Fetch and store the queued anime, returning what was added to the database"""
+        anime_list: list[AnimeData] = []
+        relations: list[AnimeRelation] = []
+        while len(self.pending) >= (MAX_ANIME_PER_QUERY if full_batches_only else 1):
+            batch = list(self.pending)[:MAX_ANIME_PER_QUERY]
+            log.info(f"[.] Fetching {len(batch)} queued anime")
+            datas = get_anime_data_from_id(batch)
+            if datas is None:
+                log.error(
+                    "[!] Unable to fetch the queued anime, they will be retried on the next cycle")
+                break
+            batch_anime = [v[0] for v in datas]
+            batch_relations = [r for v in datas for r in v[1]]
+            if not add_anime_bulk(batch_anime):
+                log.error("[!] Error storing the queued anime")
+                break
+            if not add_relations_bulk(batch_relations):
+                log.error("[!] Error storing the queued anime relations")
+            returned_ids = set(anime.id for anime in batch_anime)
+            self.not_found.update(i for i in batch if i not in returned_ids)
+            for anime_id in batch:
+                del self.pending[anime_id]
+            remove_anime_fetches(batch)
+            anime_list += batch_anime
+            relations += batch_relations
+        return anime_list, relations
@@ -0,0 +1,127 @@
+from custom_dataclasses import AnimeData, AnimeRelation
+from custom_logging import set_logger
+from db_interactor import get_anime_start_dates, get_relation_edges
+
+log = set_logger("FRANCHISE_RESOLVER")
+
+IGNORED_RELATION_TYPES = ["CHARACTER"]
+
+
+class FranchiseResolver:
+    """
+    Connected components of the anime relation graph.
+
+    The whole anime_relations edge list is loaded once per update cycle and
+    merged with a union-find, so finding the franchise of an anime no longer
+    costs a database round trip per node. Newly fetched anime can be merged
+    in afterwards with add().
+    """
+
+    def __init__(self):
+        self.parent: dict[int, int] = {}
+        self.members: dict[int, list[int]] = {}
+        self.parent_edges: dict[int, list[int]] = {}
+        self.start_dates: dict[int, int] = {}
+        self.load()
+
+    def load(self):
+        log.info("[.] Loading relation graph")
+        self.start_dates = get_anime_start_dates()
+        for anime_id in self.start_dates:
+            self.make_set(anime_id)
+        edges = get_relation_edges()
+        for primary_id, related_id, relation_type in edges:
+            self.add_edge(primary_id, related_id, relation_type)
+        log.info(
+            f"[+] Loaded relation graph ({len(self.start_dates)} anime, {len(edges)} relations, {len(self.members)} franchises)")
+        self.log_parent_cycles()
+
+    def add(self, anime_list: list[AnimeData], relations: list[AnimeRelation]):
+        for anime in anime_list:
+            self.start_dates[anime.id] = anime.start_date
+            self.make_set(anime.id)
+        for rel in relations:
+            self.add_edge(rel.primary_anilist_id,
+                          rel.related_anilist_id, rel.relation_type)
+
+    def make_set(self, anime_id: int):
+        if anime_id not in self.parent:
+            self.parent[anime_id] = anime_id
+            self.members[anime_id] = [anime_id]
+
+    def find(self, anime_id: int) -> int:
+        self.make_set(anime_id)
+        root = anime_id
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[anime_id] != root:
+            self.parent[anime_id], anime_id = root, self.parent[anime_id]
+        return root
+
+    def union(self, first_id: int, second_id: int):
+        first_root = self.find(first_id)
+        second_root = self.find(second_id)
+        if first_root == second_root:
+            return
+        if len(self.members[first_root]) < len(self.members[second_root]):
+            first_root, second_root = second_root, first_root
+        self.parent[second_root] = first_root
+        self.members[first_root] += self.members.pop(second_root)
+
+    def add_edge(self, primary_id: int, related_id: int, relation_type: str):
+        if relation_type in IGNORED_RELATION_TYPES:
+            return
+        if relation_type == "PARENT":
+            parents = self.parent_edges.setdefault(primary_id, [])
+            if related_id not in parents:
+                parents.append(related_id)
+        self.union(primary_id, related_id)
+
+    def component(self, anime_id: int) -> list[int]:
+        return self.members[self.find(anime_id)]
+
+    def missing(self, anime_id: int) -> list[int]:
+        """Members of the franchise that are referenced by a relation but not stored yet"""
+        return [i for i in self.component(anime_id) if i not in self.start_dates]
+
+    def franchise_root(self, anime_id: int) -> int:
+        """
+        Earliest main story entry of the franchise: anime without a PARENT
+        relation are main story, the rest are spinoffs and are only used
+        when the franchise has no main story at all
+        """
+        known = [i for i in self.component(anime_id) if i in self.start_dates]
+        main_story = [i for i in known if i not in self.parent_edges]
+        candidates = main_story if len(main_story) > 0 else known
+        return min(candidates, key=lambda i: (self.start_dates[i] or 0, i))
+
+    def find_parent_cycles(self) -> list[list[int]]:
+        """Iterative three-colour DFS over the PARENT edges, linear in their number"""
+        cycles: list[list[int]] = []
+        state: dict[int, int] = {}  # 1: on the current path, 2: done
+        for start in self.parent_edges:
+            if start in state:
+                continue
+            path: list[int] = [start]
+            iterators = [iter(self.parent_edges.get(start, []))]
+            state[start] = 1
+            while path:
+                next_id = next(iterators[-1], None)
+                if next_id is None:
+                    state[path.pop()] = 2
+                    iterators.pop()
+                    continue
+                if state.get(next_id) == 1:
+                    cycles.append(path[path.index(next_id):])
+                    continue
+                if next_id in state:
+                    continue
+                state[next_id] = 1
+                path.append(next_id)
+                iterators.append(iter(self.parent_edges.get(next_id, [])))
+        return cycles
+
+    def log_parent_cycles(self):
+        for cycle in self.find_parent_cycles():
+            log.error(
+                f"[!] Anilist api has an error, anime {' -> '.join(str(i) for i in cycle)} are parent of each other")
@@ -12,9 +12,6 @@ query AnimeDataFromId($mediaId: [Int], $page: Int, $perPage: Int) {
                 romaji
                 english
             }
-            nextAiringEpisode {
-                episode
-            }
             coverImage {
                 extraLarge
             }
@@ -41,6 +38,14 @@ query AnimeDataFromId($mediaId: [Int], $page: Int, $perPage: Int) {
 }
 '''
 
+GET_ANILIST_ID_FROM_USERNAME = '''
+query ($name: String) {
+  User(name: $name) {
+    id
+  }
+}
+'''
+
 GET_WATCHED_ANIME = '''
 query ($userName: String) {
   MediaListCollection(userName: $userName, type: ANIME) {
@@ -75,6 +80,30 @@ query ($id: Int, $page: Int, $createdAtGreater: Int) {
 }
 '''
 
+# One aliased Page per user, see build_batch_user_activities_query
+BATCH_USER_ACTIVITIES_PAGE = '''
+  user{index}: Page(page: 1, perPage: 25) {{
+    pageInfo {{
+      hasNextPage
+    }}
+    activities(userId: $id{index}, type: ANIME_LIST, sort: [ID_DESC], createdAt_greater: $createdAtGreater{index}) {{
+      ... on ListActivity {{
+        status
+        createdAt
+        media {{
+          id
+        }}
+      }}
+    }}
+  }}
+'''
+
+def build_batch_user_activities_query(user_count: int) -> str:
+    """First GET_NEW_USER_ACTIVITIES page of user_count users, aliased user0..userN-1"""
+    variables = ", ".join(f"$id{i}: Int, $createdAtGreater{i}: Int" for i in range(user_count))
+    pages = "".join(BATCH_USER_ACTIVITIES_PAGE.format(index=i) for i in range(user_count))
+    return f"query ({variables}) {{{pages}}}\n"
+
 GET_NEW_UPDATES = '''
 query AnimeData($page: Int, $perPage: Int) {
   Page(page: $page, perPage: $perPage) {
@@ -91,6 +120,7 @@ query AnimeData($page: Int, $perPage: Int) {
       updatedAt
       nextAiringEpisode {
         episode
+        airingAt
       }
       coverImage {
         extraLarge
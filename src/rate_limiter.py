@@ -0,0 +1,132 @@
+import time
+import random
+import threading
+from typing import Mapping
+
+from custom_logging import set_logger
+
+log = set_logger("RATE_LIMITER")
+
+DEFAULT_REQUESTS_PER_MINUTE = 90
+RETRY_AFTER_FALLBACK_SECONDS = 61
+BACKOFF_BASE_SECONDS = 2
+BACKOFF_MAX_SECONDS = 60
+CIRCUIT_BREAKER_SECONDS = 60 * 60
+
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def parse_header_int(headers: Mapping[str, str], key: str) -> int | None:
+    value = headers.get(key)
+    if value is None or not value.strip().isdigit():
+        return None
+    return int(value.strip())
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every request sent to the same api.
+
+    The bucket refills at the per minute limit advertised by the
+    X-RateLimit-Limit header and is clamped to X-RateLimit-Remaining, so
+    requests are paced to the real budget. A Retry-After pauses the bucket,
+    a 403 opens the circuit breaker: while it is open requests are refused
+    right away instead of blocking the caller.
+
+    With a priority_share, that share of the budget is kept in a bucket of
+    its own for priority requests, so they don't queue behind the tokens
+    other requests already reserved. The other requests may use a priority
+    token while that bucket is full, the whole budget is used when there
+    is no priority request to serve.
+    """
+
+    def __init__(self, requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE, burst: int | None = None,
+                 priority_share: float = 0.0):
+        self.lock = threading.Lock()
+        self.capacity = float(requests_per_minute)
+        # Requests that can be sent back to back, the whole minute budget by default
+        self.burst = float(burst) if burst is not None else None
+        if not 0 <= priority_share < 1:
+            raise Exception(f"The priority share must be in [0, 1), got {priority_share}")
+        self.priority_share = priority_share
+        self.tokens = self.max_tokens * (1 - self.priority_share)
+        self.priority_tokens = self.max_tokens * self.priority_share
+        # Tokens are refilled from this moment, it is in the future while paused
+        self.updated_at = time.monotonic()
+        self.circuit_open_until = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / 60
+
+    @property
+    def max_tokens(self) -> float:
+        return min(self.capacity, self.burst) if self.burst is not None else self.capacity
+
+    def refill(self, now: float):
+        if now > self.updated_at:
+            elapsed = now - self.updated_at
+            share = self.priority_share
+            self.tokens = min(self.max_tokens * (1 - share), self.tokens +
+                              elapsed * self.rate * (1 - share))
+            self.priority_tokens = min(self.max_tokens * share, self.priority_tokens +
+                                       elapsed * self.rate * share)
+            self.updated_at = now
+
+    def reserve(self, priority: bool = False) -> float | None:
+        """Take a token, returning how many seconds to wait before using it or None if the circuit is open"""
+        with self.lock:
+            now = time.monotonic()
+            if now < self.circuit_open_until:
+                return None
+            self.refill(now)
+            wait = max(0.0, self.updated_at - now)
+            share = self.priority_share
+            if share > 0 and (priority or (self.tokens < 1 and self.priority_tokens >= self.max_tokens * share)):
+                self.priority_tokens -= 1
+                if self.priority_tokens < 0:
+                    wait += -self.priority_tokens / (self.rate * share)
+                return wait
+            self.tokens -= 1
+            if self.tokens < 0:
+                wait += -self.tokens / (self.rate * (1 - share))
+            return wait
+
+    def update(self, headers: Mapping[str, str]):
+        limit = parse_header_int(headers, "X-RateLimit-Limit")
+        remaining = parse_header_int(headers, "X-RateLimit-Remaining")
+        with self.lock:
+            self.refill(time.monotonic())
+            share = self.priority_share
+            if limit is not None and limit > 0 and limit != self.capacity:
+                log.info(f"[i] Rate limit is now {limit} requests per minute")
+                self.capacity = float(limit)
+                self.tokens = min(self.tokens, self.max_tokens * (1 - share))
+                self.priority_tokens = min(self.priority_tokens, self.max_tokens * share)
+            if remaining is not None:
+                self.tokens = min(self.tokens, remaining * (1 - share))
+                self.priority_tokens = min(self.priority_tokens, remaining * share)
+
+    def pause(self, headers: Mapping[str, str]) -> int:
+        """Stop handing out tokens for the Retry-After time, returns the pause length"""
+        retry_after = parse_header_int(headers, "Retry-After")
+        seconds = retry_after + 1 if retry_after is not None else RETRY_AFTER_FALLBACK_SECONDS
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.updated_at = max(self.updated_at, now + seconds)
+            self.tokens = min(self.tokens, 0.0)
+            self.priority_tokens = min(self.priority_tokens, 0.0)
+        return seconds
+
+    def open_circuit(self):
+        with self.lock:
+            self.circuit_open_until = time.monotonic() + CIRCUIT_BREAKER_SECONDS
+        log.warning(
+            f"[!] Circuit breaker opened, requests are refused for the next {CIRCUIT_BREAKER_SECONDS} seconds")
+
+    def is_circuit_open(self) -> bool:
+        return time.monotonic() < self.circuit_open_until
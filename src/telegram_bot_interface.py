@@ -1,3 +1,4 @@
+import html
 import asyncio
 import logging
 import requests
@@ -12,11 +13,11 @@ from telegram.ext import (
 )
 from telegram import Update
 import custom_config
-from db_interactor import add_user, check_and_update_telegram_user, get_user_info_by_telegram_id, update_anilist_username
+from db_interactor import add_user, check_and_update_telegram_user, get_user_info_by_telegram_id, set_notification_mode, update_anilist_username
 
 
 from custom_logging import set_logger
-from daemon_connectors import main_daemon_job
+from daemon_connectors import drain_notification_outbox, main_daemon_job, onboard_user, refresh_aired_anime
 
 log = set_logger("TELEGRAM_BOT", logging.INFO)
 
@@ -33,6 +34,8 @@ def set_bot_commands():
         {"command": "status", "description": "Get the user status"},
         {"command": "change-anilist-username",
             "description": "Change your referred anilist username"},
+        {"command": "digest",
+            "description": "Get your notifications merged in periodic digests (on/off)"},
     ]
 
     requests.post(url, json={"commands": commands}, timeout=30)
@@ -53,7 +56,8 @@ async def help_command(update: Update, _ : ContextTypes.DEFAULT_TYPE):
         "<b>❓ Need help with Anipush?</b>\n"
         "<i>Work in progress...\n\n"
         "Use /start to register your Anilist username.\n"
-        "Use /changeusername to update your Anilist username.</i>"
+        "Use /changeusername to update your Anilist username.\n"
+        "Use /digest to get your notifications merged in periodic digests.</i>"
     )
     log.info("Sending help message to "+str(user.id))
     await update.message.reply_text(onboarding_message_text, parse_mode="HTML")
@@ -85,7 +89,46 @@ async def start_command(update: Update, _ : ContextTypes.DEFAULT_TYPE):
     return ASK_ANILIST_USERNAME
 
 
-async def receive_anilist_username(update: Update, _ : ContextTypes.DEFAULT_TYPE):
+async def onboarding_task(update: Update, telegram_id: int, anilist_username: str):
+    """Import the anilist list of a new user right away, editing one message with the progress"""
+    if update.message is None:
+        return
+    progress_message = await update.message.reply_text(
+        "<b>⏳ Importing your Anilist list...</b>", parse_mode="HTML")
+    last_text = ""
+
+    async def report(imported: int, total: int):
+        nonlocal last_text
+        text = f"<b>⏳ Importing your Anilist list...</b>\n\nImported {imported}/{total} anime"
+        if text == last_text:
+            return
+        last_text = text
+        try:
+            await progress_message.edit_text(text, parse_mode="HTML")
+        except Exception as e:
+            log.warning(f"Could not update the onboarding progress of {telegram_id}: {e}")
+
+    try:
+        followed = await onboard_user(telegram_id, anilist_username, report)
+    except Exception as e:
+        log.error(f"Onboarding of {telegram_id} failed: {e}")
+        followed = None
+    if followed is None:
+        text = (
+            "<b>⚠️ Your Anilist list could not be fully imported yet.</b>\n\n"
+            "It will be completed in the background, check that "
+            f"<b>{html.escape(anilist_username)}</b> is your Anilist username and that your list is public.\n"
+            "Use /changeusername to fix it."
+        )
+    else:
+        text = f"<b>🎉 All set!</b>\n\nYou are now following <b>{followed}</b> anime."
+    try:
+        await progress_message.edit_text(text, parse_mode="HTML")
+    except Exception as e:
+        log.warning(f"Could not send the onboarding result to {telegram_id}: {e}")
+
+
+async def receive_anilist_username(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if user is None:
         log.info("RECEIVE_ANILIST_USERNAME called but user is None")
@@ -104,6 +147,8 @@ async def receive_anilist_username(update: Update, _ : ContextTypes.DEFAULT_TYPE
         f"<b>✅ Thank you!</b>\n\nYour Anilist username <b>{anilist_username}</b> has been saved.",
         parse_mode="HTML"
     )
+    # Not awaited: the import runs in the background while the bot keeps answering
+    context.application.create_task(onboarding_task(update, user.id, anilist_username))
     return ConversationHandler.END
 
 
@@ -144,16 +189,63 @@ async def status_command(update: Update, _: ContextTypes.DEFAULT_TYPE):
         f"<b>👤 Your Anipush Status</b>\n\n"
         f"<b>Anilist username:</b> {info['anilist_username'] or '<i>Not set</i>'}\n"
         f"<b>Anilist ID:</b> {info['anilist_id'] or '<i>Not set</i>'}\n"
-        f"<b>Last activity checked:</b> {info['last_activity_checked'] or '<i>Never</i>'}"
+        f"<b>Last activity checked:</b> {info['last_activity_checked'] or '<i>Never</i>'}\n"
+        f"<b>Notifications:</b> {info['notification_mode'].title()}"
     )
     await update.message.reply_text(msg, parse_mode="HTML")
 
 
+async def digest_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user is None:
+        log.info("DIGEST called but user is None")
+        return
+    if update.message is None:
+        log.info("DIGEST called but message is None")
+        return
+    log.info(f"DIGEST called by {user.id} {user.username}")
+    info = get_user_info_by_telegram_id(user.id)
+    if not info:
+        await update.message.reply_text(
+            "<b>ℹ️ No user info found.</b>\nUse /start to register your Anilist username.",
+            parse_mode="HTML"
+        )
+        return
+    args = [a.lower() for a in (context.args or [])]
+    if args and args[0] in ["on", "off"]:
+        digest = args[0] == "on"
+    else:
+        digest = info["notification_mode"] != "digest"
+    set_notification_mode(user.id, "digest" if digest else "instant")
+    if digest:
+        minutes = max(1, custom_config.DIGEST_WINDOW_SECONDS // 60)
+        msg = (
+            "<b>📬 Digest mode enabled</b>\n\n"
+            f"Your notifications will be merged in one message at most every {minutes} minutes.\n"
+            "Use /digest off to get them right away again."
+        )
+    else:
+        msg = (
+            "<b>🔔 Instant notifications enabled</b>\n\n"
+            "You will get every notification right away.\n"
+            "Use /digest on to get them merged in periodic digests."
+        )
+    await update.message.reply_text(msg, parse_mode="HTML")
+
+
 async def process_users_job(_: CallbackContext):
     log.info("[JOB] Running process_users_with_missing_anilist_id...")
     await asyncio.get_event_loop().run_in_executor(None, main_daemon_job)
 
 
+async def airing_refresh_job(_: CallbackContext):
+    await asyncio.get_event_loop().run_in_executor(None, refresh_aired_anime)
+
+
+async def outbox_job(_: CallbackContext):
+    await asyncio.get_event_loop().run_in_executor(None, drain_notification_outbox)
+
+
 def init_telegram_bot():
     app = ApplicationBuilder().token(custom_config.BOT_TOKEN).build()
     if app.job_queue is None:
@@ -164,7 +256,8 @@ def init_telegram_bot():
             CommandHandler("help", help_command),
             CommandHandler("start", start_command),
             CommandHandler("changeusername", change_anilist_command),
-            CommandHandler("status", status_command)
+            CommandHandler("status", status_command),
+            CommandHandler("digest", digest_command)
         ],
         states={
             ASK_ANILIST_USERNAME: [MessageHandler(
@@ -176,6 +269,8 @@ def init_telegram_bot():
     app.add_handler(conv_handler)
     set_bot_commands()
     app.job_queue.run_repeating(process_users_job, interval=60, first=5)
+    app.job_queue.run_repeating(airing_refresh_job, interval=60, first=30)
+    app.job_queue.run_repeating(outbox_job, interval=15, first=10)
     log.info("Bot avviato...")
 
     app.run_polling()
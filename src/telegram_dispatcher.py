@@ -0,0 +1,275 @@
+import json
+import asyncio
+from dataclasses import replace
+
+import httpx
+
+import custom_config
+from custom_dataclasses import DeliveryResult, TelegramNotification
+from custom_logging import set_logger
+from rate_limiter import RateLimiter, backoff_delay
+from utils import build_digest_header, build_digest_summary
+
+log = set_logger("TELEGRAM_DISPATCHER")
+
+TELEGRAM_API_URL = "https://api.telegram.org/bot{token}/{method}"
+MAX_SEND_ATTEMPTS = 3
+MAX_CONCURRENT_SENDS = 10
+# Telegram bot limits: about 30 messages per second overall, one per second
+# in the same private chat and 20 per minute in the same group
+GLOBAL_MESSAGES_PER_SECOND = 30
+PRIVATE_CHAT_MESSAGES_PER_MINUTE = 60
+GROUP_CHAT_MESSAGES_PER_MINUTE = 20
+# Telegram descriptions of the errors no later send to the chat can avoid,
+# besides any 403 (blocked by the user, kicked from the group...)
+UNREACHABLE_CHAT_ERRORS = ["chat not found", "user is deactivated", "bot was blocked", "bot was kicked"]
+# Telegram descriptions of a 400 caused by the photo itself, e.g. a file_id it no longer knows
+FILE_ERRORS = ["wrong file identifier", "failed to get http url content", "wrong remote file", "wrong type of the web page content"]
+MAX_MEDIA_GROUP_SIZE = 10
+MAX_MESSAGE_LENGTH = 4096
+
+
+def is_chat_unreachable(status_code: int, error: str | None) -> bool:
+    """Whether the error means no message can be sent to the chat anymore, not just this one"""
+    if status_code == 403:
+        return True
+    error = (error or "").lower()
+    return any(e in error for e in UNREACHABLE_CHAT_ERRORS)
+
+
+def is_file_error(result: DeliveryResult) -> bool:
+    """Whether the send failed because of the photo, not because of the chat or the message"""
+    if result.chat_unreachable or result.status_code != 400:
+        return False
+    error = (result.error or "").lower()
+    return any(e in error for e in FILE_ERRORS)
+
+
+def photo_file_id(message: dict) -> str | None:
+    """file_id of the largest size of the photo in a sent message"""
+    photos = message.get("photo") or []
+    return photos[-1].get("file_id") if photos else None
+
+
+class TelegramDispatcher:
+    """
+    Sends notifications through one pooled httpx.AsyncClient.
+
+    Every message takes a token from the global bucket and from the bucket of
+    its chat, so messages to different chats go out in parallel while a
+    single chat is never flooded. A 429 pauses the chat for the retry_after
+    time Telegram asks for and the message is sent again.
+
+    Covers are sent by the file_id Telegram returned for their first upload
+    when it is known (file_ids, by cover url), so a cover is downloaded from
+    AniList once instead of once per chat.
+
+    Once a chat turns out to be unreachable (unreachable_chats, the error by
+    chat id), its remaining messages fail without being sent.
+    """
+
+    def __init__(self, file_ids: dict[str, str] | None = None):
+        self.client = httpx.AsyncClient(
+            timeout=30,
+            limits=httpx.Limits(max_connections=MAX_CONCURRENT_SENDS, max_keepalive_connections=MAX_CONCURRENT_SENDS)
+        )
+        self.global_limiter = RateLimiter(
+            GLOBAL_MESSAGES_PER_SECOND * 60, burst=GLOBAL_MESSAGES_PER_SECOND)
+        self.chat_limiters: dict[int, RateLimiter] = {}
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+        self.file_ids: dict[str, str] = dict(file_ids or {})
+        self.cover_locks: dict[str, asyncio.Lock] = {}
+        self.unreachable_chats: dict[int, str] = {}
+
+    async def __aenter__(self) -> "TelegramDispatcher":
+        return self
+
+    async def __aexit__(self, *_):
+        await self.client.aclose()
+
+    def chat_limiter(self, telegram_id: int) -> RateLimiter:
+        if telegram_id not in self.chat_limiters:
+            # Group and channel ids are negative
+            per_minute = GROUP_CHAT_MESSAGES_PER_MINUTE if telegram_id < 0 else PRIVATE_CHAT_MESSAGES_PER_MINUTE
+            self.chat_limiters[telegram_id] = RateLimiter(per_minute, burst=1)
+        return self.chat_limiters[telegram_id]
+
+    async def wait_for_turn(self, telegram_id: int):
+        for limiter in [self.chat_limiter(telegram_id), self.global_limiter]:
+            await asyncio.sleep(limiter.reserve() or 0)
+
+    def skip_unreachable(self, telegram_id: int, result: DeliveryResult) -> bool:
+        """Fail result without sending it if the chat is already known to be unreachable"""
+        if telegram_id not in self.unreachable_chats:
+            return False
+        result.error, result.retryable, result.chat_unreachable = self.unreachable_chats[telegram_id], False, True
+        return True
+
+    async def deliver(self, telegram_id: int, method: str, data: dict, result: DeliveryResult) -> dict | None:
+        """
+        Call the bot api method until it succeeds or can't succeed, storing
+        the outcome in result. Returns the response body if it succeeded
+        """
+        body = None
+        url = TELEGRAM_API_URL.format(token=custom_config.BOT_TOKEN, method=method)
+        while result.attempts < MAX_SEND_ATTEMPTS:
+            if self.skip_unreachable(telegram_id, result):
+                return None
+            await self.wait_for_turn(telegram_id)
+            # The chat may have turned out unreachable while waiting for its turn
+            if self.skip_unreachable(telegram_id, result):
+                return None
+            result.attempts += 1
+            try:
+                async with self.semaphore:
+                    response = await self.client.post(url, data=data)
+            except Exception as e:
+                result.status_code, result.error, result.retryable = None, str(e), True
+                await asyncio.sleep(backoff_delay(result.attempts))
+                continue
+            result.status_code = response.status_code
+            if response.status_code == 200:
+                result.delivered, result.error, result.retryable = True, None, False
+                body = response.json()
+                break
+            error_body = response.json() if response.headers.get("content-type", "").startswith("application/json") else {}
+            result.error = error_body.get("description", response.text)
+            if response.status_code == 429:
+                retry_after = (error_body.get("parameters") or {}).get("retry_after")
+                pause = self.chat_limiter(telegram_id).pause(
+                    {"Retry-After": str(retry_after)} if retry_after is not None else {})
+                log.warning(
+                    f"[!] Telegram rate limit hit for chat {telegram_id}, retrying in {pause} seconds")
+                result.retryable = True
+                continue
+            if response.status_code >= 500:
+                result.retryable = True
+                await asyncio.sleep(backoff_delay(result.attempts))
+                continue
+            # Any other 4xx (blocked bot, chat not found, bad request) won't get better
+            result.retryable = False
+            result.chat_unreachable = is_chat_unreachable(response.status_code, result.error)
+            if result.chat_unreachable:
+                self.unreachable_chats[telegram_id] = result.error or ""
+            break
+        if not result.delivered:
+            log.error(
+                f"[!] Failed to send Telegram {method} to {telegram_id}: {result.error}")
+        return body
+
+    def forget_file_ids(self, covers: list[str]):
+        log.warning(
+            f"[!] Telegram refused {len(covers)} cached cover file ids, uploading them again")
+        for cover in covers:
+            self.file_ids.pop(cover, None)
+
+    async def send(self, notification: TelegramNotification) -> DeliveryResult:
+        cover = notification.event.photo
+        if cover and cover not in self.file_ids:
+            # The first send of a cover uploads it, the others wait for its file_id
+            lock = self.cover_locks.setdefault(cover, asyncio.Lock())
+            async with lock:
+                if cover not in self.file_ids:
+                    return await self.send_photo(notification)
+        return await self.send_photo(notification)
+
+    async def send_photo(self, notification: TelegramNotification) -> DeliveryResult:
+        result = DeliveryResult(notification=notification, delivered=False)
+        cover = notification.event.photo
+        file_id = self.file_ids.get(cover)
+        data = {
+            'chat_id': str(notification.telegram_id),
+            'caption': notification.event.caption,
+            'photo': file_id or cover,
+            'parse_mode': 'HTML'
+        }
+        body = await self.deliver(notification.telegram_id, "sendPhoto", data, result)
+        if file_id is not None and is_file_error(result):
+            self.forget_file_ids([cover])
+            return await self.send_photo(notification)
+        if body is not None and file_id is None:
+            result.file_id = photo_file_id(body.get("result") or {})
+            if result.file_id is not None:
+                self.file_ids[cover] = result.file_id
+        return result
+
+    async def send_digest(self, notifications: list[TelegramNotification]) -> list[DeliveryResult]:
+        """
+        Send the notifications of one chat as a single message: an album of
+        the covers with a short caption each, or a text summary when they
+        don't fit in one album. Every notification gets the same outcome.
+        """
+        if len(notifications) == 1:
+            return [await self.send(notifications[0])]
+        lines = [n.event.digest_line for n in notifications]
+        if len(notifications) <= MAX_MEDIA_GROUP_SIZE and all(n.event.photo for n in notifications):
+            return await self.send_media_group(notifications, lines)
+        telegram_id = notifications[0].telegram_id
+        result = DeliveryResult(notification=notifications[0], delivered=False)
+        data = {
+            'chat_id': str(telegram_id),
+            'text': build_digest_summary(lines, MAX_MESSAGE_LENGTH),
+            'parse_mode': 'HTML'
+        }
+        await self.deliver(telegram_id, "sendMessage", data, result)
+        return [replace(result, notification=n) for n in notifications]
+
+    async def send_media_group(self, notifications: list[TelegramNotification], lines: list[str]) -> list[DeliveryResult]:
+        telegram_id = notifications[0].telegram_id
+        result = DeliveryResult(notification=notifications[0], delivered=False)
+        covers = [n.event.photo for n in notifications]
+        cached = [self.file_ids.get(cover) for cover in covers]
+        media = [
+            {'type': 'photo', 'media': file_id or cover, 'caption': line, 'parse_mode': 'HTML'}
+            for cover, file_id, line in zip(covers, cached, lines)
+        ]
+        media[0]['caption'] = build_digest_header(len(notifications)) + "\n\n" + lines[0]
+        data = {'chat_id': str(telegram_id), 'media': json.dumps(media)}
+        body = await self.deliver(telegram_id, "sendMediaGroup", data, result)
+        if any(cached) and is_file_error(result):
+            self.forget_file_ids([cover for cover, file_id in zip(covers, cached) if file_id])
+            return await self.send_media_group(notifications, lines)
+        results = [replace(result, notification=n) for n in notifications]
+        if body is not None:
+            for r, cover, file_id, message in zip(results, covers, cached, body.get("result") or []):
+                if file_id is None:
+                    r.file_id = photo_file_id(message)
+                    if r.file_id is not None:
+                        self.file_ids[cover] = r.file_id
+        return results
+
+    async def send_all(self, notifications: list[TelegramNotification],
+                       digests: list[list[TelegramNotification]]) -> list[DeliveryResult]:
+        results = await asyncio.gather(
+            *[self.send(n) for n in notifications], *[self.send_digest(d) for d in digests])
+        flat: list[DeliveryResult] = []
+        for r in results:
+            flat.extend(r if isinstance(r, list) else [r])
+        return flat
+
+
+async def dispatch_notifications_async(notifications: list[TelegramNotification],
+                                       digests: list[list[TelegramNotification]],
+                                       file_ids: dict[str, str]) -> list[DeliveryResult]:
+    async with TelegramDispatcher(file_ids) as dispatcher:
+        return await dispatcher.send_all(notifications, digests)
+
+
+def dispatch_notifications(notifications: list[TelegramNotification],
+                           digests: list[list[TelegramNotification]] | None = None,
+                           file_ids: dict[str, str] | None = None) -> list[DeliveryResult]:
+    """
+    Send the notifications from a thread without an event loop (the daemon
+    jobs), each digest (the notifications of one chat) as a single message.
+    file_ids are the known cover uploads, by cover url.
+    Returns one result each, the notifications first and then the digests
+    """
+    digests = digests or []
+    if len(notifications) == 0 and len(digests) == 0:
+        return []
+    log.info(f"[.] Sending {len(notifications)} notifications and {len(digests)} digests")
+    results = asyncio.run(dispatch_notifications_async(notifications, digests, file_ids or {}))
+    delivered = len([r for r in results if r.delivered])
+    log.info(
+        f"[+] Sent {delivered}/{len(results)} notifications")
+    return results
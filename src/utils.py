@@ -1,15 +1,17 @@
 
+import html
 import datetime
-import time
-import requests
 
-import custom_config
-from custom_dataclasses import AnimeData
+from custom_dataclasses import AnimeData, NotificationEvent
 from custom_logging import set_logger
 
 log = set_logger("UTILS")
 
 
+def chunk_list(values: list, size: int) -> list[list]:
+    return [values[i:i+size] for i in range(0, len(values), size)]
+
+
 def format_date(ts):
     try:
         ts = int(ts)
@@ -62,39 +64,68 @@ def format_type(type_str: str):
     return t.replace('_', ' ').title()
 
 
-def send_telegram_notification(telegram_id: int, anime: AnimeData, notification_type: str):
-    try:
-        url = f"https://api.telegram.org/bot{custom_config.BOT_TOKEN}/sendPhoto"
-        custom_text = ""
-        sub_text = ""
-        if notification_type == "new":
-            custom_text = "New anime found!"
-            sub_text = f"Found anime <b>{anime.title}</b> ({format_type(anime.type)})"
-        elif notification_type == "status_change":
-            custom_text = "Anime status changed!"
-            sub_text = f"The anime {anime.title} ({format_type(anime.type)}) has changed status to <b>{format_status_plain(anime.status)}</b>"
-        elif notification_type == "episode_update":
-            custom_text = "New episode out!"
-            sub_text = f"The <b>episode {anime.latest_aired_episode or anime.episodes}</b> of {anime.title} is out!"
-        caption = (
-            f"<b>🔔 {custom_text}!</b>\n"
-            f"\n{sub_text}\n\n"
-            f"<b>Title:</b> {anime.title}\n"
-            f"<b>Type:</b> {format_type(anime.type)}\n"
-            f"<b>Status:</b> {format_status_plain(anime.status)}\n"
-            f"<b>Episodes:</b> {anime.episodes}\n"
-            f"<b>Latest aired episode:</b> {anime.latest_aired_episode}\n" if anime.latest_aired_episode else ""
-            f"<b>Start date:</b> {format_date(anime.start_date)}\n" if anime.start_date else ""
-            f"<b>Updated at:</b> {format_date(anime.updated_date)}" if anime.updated_date else ""
-        )
-        data = {
-            'chat_id': str(telegram_id),
-            'caption': caption,
-            'photo': anime.cover,
-            'parse_mode': 'HTML'
-        }
-        requests.post(url, data=data, timeout=10)
-        time.sleep(5)
-    except Exception as e:
-        log.error(
-            f"[!] Failed to send Telegram notification to {telegram_id}: {e}")
+def build_notification_caption(anime: AnimeData, notification_type: str) -> str:
+    title = html.escape(anime.title or "")
+    custom_text = ""
+    sub_text = ""
+    if notification_type == "new":
+        custom_text = "New anime found"
+        sub_text = f"Found anime <b>{title}</b> ({format_type(anime.type)})"
+    elif notification_type == "status_change":
+        custom_text = "Anime status changed"
+        sub_text = f"The anime {title} ({format_type(anime.type)}) has changed status to <b>{format_status_plain(anime.status)}</b>"
+    elif notification_type == "episode_update":
+        custom_text = "New episode out"
+        sub_text = f"The <b>episode {anime.latest_aired_episode or anime.episodes}</b> of {title} is out!"
+    lines = [
+        f"<b>🔔 {custom_text}!</b>",
+        "",
+        sub_text,
+        "",
+        f"<b>Title:</b> {title}",
+        f"<b>Type:</b> {format_type(anime.type)}",
+        f"<b>Status:</b> {format_status_plain(anime.status)}",
+        f"<b>Episodes:</b> {anime.episodes}",
+    ]
+    if anime.latest_aired_episode:
+        lines.append(f"<b>Latest aired episode:</b> {anime.latest_aired_episode}")
+    if anime.start_date:
+        lines.append(f"<b>Start date:</b> {format_date(anime.start_date)}")
+    if anime.updated_date:
+        lines.append(f"<b>Updated at:</b> {format_date(anime.updated_date)}")
+    return "\n".join(lines)
+
+
+def build_digest_line(anime: AnimeData, notification_type: str) -> str:
+    title = html.escape(anime.title or "")
+    if notification_type == "new":
+        return f"🆕 New anime <b>{title}</b> ({format_type(anime.type)})"
+    elif notification_type == "status_change":
+        return f"🔄 <b>{title}</b> is now {format_status_plain(anime.status)}"
+    elif notification_type == "episode_update":
+        return f"▶️ Episode {anime.latest_aired_episode or anime.episodes} of <b>{title}</b> is out"
+    return f"🔔 <b>{title}</b>"
+
+
+def build_digest_header(update_count: int) -> str:
+    return f"<b>🔔 {update_count} anime updates</b>"
+
+
+def build_digest_summary(lines: list[str], max_length: int) -> str:
+    """Text digest of the lines, the ones over max_length are counted in a last line"""
+    text = build_digest_header(len(lines)) + "\n"
+    for i, line in enumerate(lines):
+        more = f"\n… and {len(lines) - i} more"
+        # The last line doesn't need room for the "and more" line
+        reserved = len(more) if i < len(lines) - 1 else 0
+        if len(text) + len(line) + 1 + reserved > max_length:
+            return text + more
+        text += "\n" + line
+    return text
+
+
+def render_notification_event(event: NotificationEvent, anime: AnimeData) -> NotificationEvent:
+    event.caption = build_notification_caption(anime, event.notification_type)
+    event.digest_line = build_digest_line(anime, event.notification_type)
+    event.photo = anime.cover or ""
+    return event
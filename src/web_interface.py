@@ -1,10 +1,9 @@
 import time
-import sqlite3
 from flask import Flask, render_template_string, request
-import custom_config
 from utils import format_date, format_status_plain, format_type
 from custom_logging import set_logger
 from db_interactor import get_anime_data
+from db_connection import connection
 
 
 log = set_logger("WEB_INTERFACE")
@@ -354,55 +353,51 @@ DETAIL_HTML = '''
 '''
 
 
-def get_user_anime_ids(anilist_id: int) -> list[tuple[int, str]]:
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-SELECT anime_id, a.related_to FROM user_anime ua join anime a on ua.anime_id=a.id WHERE ua.anilist_user_id=?
-    """,
-                   (anilist_id,)
-                   )
-    res = cursor.fetchall()
-    conn.close()
+def get_user_anime_ids(anilist_id: int) -> list[tuple[int, int | None]]:
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+SELECT ua.anime_id, fm.franchise_id FROM user_anime ua
+JOIN anime a ON ua.anime_id=a.id
+LEFT JOIN franchise_member fm ON fm.anime_id=ua.anime_id
+WHERE ua.anilist_user_id=?
+        """,
+                       (anilist_id,)
+                       )
+        res = cursor.fetchall()
     return res
 
 
 def get_anilist_id_from_username(username: str) -> int | None:
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT anilist_id FROM users WHERE anilist_username=?", (username,))
-    res = cursor.fetchone()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT anilist_id FROM users WHERE anilist_username=?", (username,))
+        res = cursor.fetchone()
     if res:
         return res[0]
     return None
 
 
-def get_related_anime(anime_id: int, related_to: str | None = None) -> list[tuple[int, int]]:
-    conn = sqlite3.connect(custom_config.DATABASE_PATH)
-    cursor = conn.cursor()
-    related_to_values = []
-    if related_to is None:
-        cursor.execute("SELECT related_to FROM anime WHERE id=?", (anime_id,))
-        res = cursor.fetchone()
-        if not res or res[0] is None or res[0] == '':
-            conn.close()
-            return [(anime_id, 0)]
-        related_to_values = res[0].split('|')
-    else:
-        related_to_values = related_to.split('|')
-    related_string = ''
-    for v in related_to_values:
-        related_string += f"or '|'||related_to||'|' like '%|{v}|%' "
-    related_string = related_string[3:]
-    query = f"SELECT id, start_date FROM anime WHERE {related_string}"
-    cursor.execute(query)
-    all_anime = cursor.fetchall()
+def get_related_anime(anime_id: int, franchise_ids: list[int] | None = None) -> list[tuple[int, int]]:
+    with connection() as conn:
+        cursor = conn.cursor()
+        if franchise_ids is None:
+            cursor.execute("""
+                SELECT DISTINCT a.id, a.start_date FROM franchise_member own
+                JOIN franchise_member fm ON fm.franchise_id = own.franchise_id
+                JOIN anime a ON a.id = fm.anime_id
+                WHERE own.anime_id = ?
+            """, (anime_id,))
+        else:
+            cursor.execute(f"""
+                SELECT DISTINCT a.id, a.start_date FROM franchise_member fm
+                JOIN anime a ON a.id = fm.anime_id
+                WHERE fm.franchise_id IN ({",".join("?" * len(franchise_ids))})
+            """, franchise_ids)
+        all_anime = cursor.fetchall()
     if not all_anime or len(all_anime) == 0:
-        conn.close()
         return [(anime_id, 0)]
-    conn.close()
     return [(aid[0], aid[1]) for aid in all_anime]
 
 
@@ -441,17 +436,23 @@ def index():
         log.debug(f"Anilist id: {anilist_id}")
         if anilist_id:
             watched = get_user_anime_ids(anilist_id)
-            anime_to_check: dict[int, str | None] = {}
+            franchises: dict[int, list[int]] = {}
             watched_ids: dict[int, bool] = {}
             for v in watched:
-                anime_to_check[v[0]] = v[1]
+                franchises.setdefault(v[0], [])
+                if v[1] is not None:
+                    franchises[v[0]].append(v[1])
                 watched_ids[v[0]] = True
+            # Anime without a franchise, or shared by several, are not listed
+            anime_to_check: dict[int, int | None] = {
+                aid: f[0] if len(f) == 1 else None for aid, f in franchises.items()
+            }
             anime_list = []
             for anime_id, _ in anime_to_check.items():
-                if anime_to_check[anime_id] is None or '|' in (anime_to_check[anime_id] or ''):
+                if anime_to_check[anime_id] is None:
                     continue
-                group = get_related_anime(anime_id, anime_to_check[anime_id])
-                main_id = int(anime_to_check[anime_id] or '0')
+                main_id = anime_to_check[anime_id] or 0
+                group = get_related_anime(anime_id, [main_id])
                 for aid, _ in group:
                     if aid in anime_to_check:
                         anime_to_check[aid] = None